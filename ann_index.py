@@ -0,0 +1,145 @@
+"""Approximate nearest-neighbour indexes for large galleries.
+
+An index only narrows the gallery down to candidate rows for each query;
+:class:`gallery.Gallery` still computes exact distances on those rows, so
+``MATCH_THRESHOLD`` keeps its meaning. Indexes stay row-aligned with the
+gallery: ``add`` is called with rows appended at the end and ``keep`` with the
+same mask the gallery compacts with.
+
+``IVFIndex`` is a plain NumPy inverted-file index: k-means centroids, one
+list of rows per centroid, and ``nprobe`` lists scanned per query. Raising
+``nprobe`` trades latency for recall.
+"""
+import os
+import numpy as np
+
+INDEX_NAME = 'ann_index.npz'
+
+
+class IVFIndex:
+    kind = 'ivf'
+
+    def __init__(self, nlist=0, nprobe=8, min_rows=20000, iters=10, seed=0):
+        self.nlist = nlist          # 0 = 2*sqrt(N) at fit time
+        self.nprobe = nprobe
+        self.min_rows = min_rows    # below this the gallery scans linearly
+        self.iters = iters
+        self.seed = seed
+        self.centroids = None
+        self.assign = np.zeros(0, dtype=np.int32)
+        self.fitted_rows = 0
+        self._lists = None
+
+    @property
+    def trained(self):
+        return self.centroids is not None
+
+    def active(self, n):
+        return self.trained and n >= self.min_rows
+
+    def needs_fit(self, n):
+        """Untrained, or the gallery outgrew the centroids fourfold."""
+        if n < self.min_rows:
+            return False
+        return not self.trained or n > 4 * max(self.fitted_rows, 1)
+
+    # ---------- build ----------
+    def _nearest(self, x, chunk=8192):
+        out = np.empty(len(x), dtype=np.int32)
+        c = self.centroids
+        csq = np.einsum('ij,ij->i', c, c)
+        for lo in range(0, len(x), chunk):
+            xb = np.asarray(x[lo:lo + chunk], dtype=np.float32)
+            out[lo:lo + chunk] = np.argmin(csq[None, :] - 2 * xb @ c.T, axis=1)
+        return out
+
+    def fit(self, matrix):
+        matrix = np.asarray(matrix, dtype=np.float32)
+        n = len(matrix)
+        if not n:
+            return self
+        k = self.nlist or int(2 * np.sqrt(n))
+        k = max(1, min(k, n))
+        rng = np.random.default_rng(self.seed)
+        sample = matrix[rng.choice(n, min(n, max(32 * k, 10000)), replace=False)]
+        self.centroids = sample[rng.choice(len(sample), k, replace=False)].copy()
+        for _ in range(self.iters):
+            lab = self._nearest(sample)
+            order = np.argsort(lab, kind='stable')
+            live, starts, counts = np.unique(lab[order], return_index=True, return_counts=True)
+            sums = np.add.reduceat(sample[order], starts, axis=0)
+            self.centroids[live] = sums / counts[:, None]
+        self.assign = self._nearest(matrix)
+        self.fitted_rows = n
+        self._lists = None
+        return self
+
+    # ---------- row-aligned edits ----------
+    def add(self, encodings):
+        if not self.trained:
+            return
+        self.assign = np.concatenate([self.assign, self._nearest(encodings)])
+        self._lists = None
+
+    def keep(self, mask):
+        if not self.trained:
+            return
+        self.assign = self.assign[np.asarray(mask, dtype=bool)]
+        self._lists = None
+
+    # ---------- search ----------
+    def _inverted(self):
+        if self._lists is None:
+            order = np.argsort(self.assign, kind='stable').astype(np.int64)
+            offsets = np.searchsorted(self.assign[order], np.arange(len(self.centroids) + 1))
+            self._lists = (order, offsets)
+        return self._lists
+
+    def probe(self, query):
+        """Candidate gallery rows for one query vector."""
+        order, offsets = self._inverted()
+        q = np.asarray(query, dtype=np.float32).reshape(-1)
+        c = self.centroids
+        d = np.einsum('ij,ij->i', c, c) - 2 * c @ q
+        p = min(self.nprobe, len(c))
+        lists = np.argpartition(d, p - 1)[:p] if p < len(c) else np.arange(len(c))
+        return np.concatenate([order[offsets[l]:offsets[l + 1]] for l in lists])
+
+    # ---------- persistence ----------
+    def save(self, path, tag=''):
+        if not self.trained:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        tmp = path + '.tmp.npz'
+        np.savez(tmp, kind=self.kind, tag=tag, centroids=self.centroids,
+                 assign=self.assign, fitted_rows=self.fitted_rows)
+        os.replace(tmp, path)
+
+    def load(self, path, tag='', n=None):
+        """Load saved lists; returns False when missing or built for other rows."""
+        if not os.path.exists(path):
+            return False
+        with np.load(path) as z:
+            if str(z['kind']) != self.kind or str(z['tag']) != tag:
+                return False
+            if n is not None and len(z['assign']) != n:
+                return False
+            self.centroids = z['centroids']
+            self.assign = z['assign']
+            self.fitted_rows = int(z['fitted_rows'])
+        self._lists = None
+        return True
+
+
+INDEXES = {'ivf': IVFIndex}
+
+
+def make_index(kind, **params):
+    """Index for ``kind`` (``none`` or a key of ``INDEXES``)."""
+    if not kind or kind == 'none':
+        return None
+    try:
+        return INDEXES[kind](**params)
+    except KeyError:
+        raise ValueError(f'unknown ANN index {kind!r}; choose from none, {", ".join(INDEXES)}')
@@ -1,45 +1,178 @@
-import os, io, json, base64
-from datetime import datetime, date
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, send_from_directory
+import os, json, hmac, time, base64, shutil, socket, smtplib, sqlite3
+from datetime import datetime, date, timedelta
+from collections import deque
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, send_from_directory, Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from flask_mail import Mail, Message
 from itsdangerous import URLSafeTimedSerializer
-from flask_socketio import SocketIO, emit
+from flask_socketio import SocketIO, emit, join_room
 from apscheduler.schedulers.background import BackgroundScheduler
 from werkzeug.utils import secure_filename
-from PIL import Image
 import numpy as np
-import face_recognition
+from encoding_store import EncodingStore
+from ann_index import make_index
+from inference import InferenceService, InferenceBusy, InferenceTimeout, InferenceFailed, analyze_batch
+from batcher import MicroBatcher
+from tracking import FaceTracker
+from detection import Detector
+from quality import QualityGate, distinct
+import metrics
+import reports
+import video
 
 # ---------------- config ----------------
 BASE = os.path.dirname(os.path.abspath(__file__))
-FACE_DIR = os.path.join(BASE, 'face_data')
-MODEL_DIR = os.path.join(BASE, 'models')
-ENC_FILE = os.path.join(MODEL_DIR, 'encodings.json')
+FACE_DIR = os.getenv('FACE_DIR', os.path.join(BASE, 'face_data'))
+MODEL_DIR = os.getenv('MODEL_DIR', os.path.join(BASE, 'models'))
+REPORT_DIR = os.getenv('REPORT_DIR', os.path.join(BASE, 'reports'))  # background report files
+VIDEO_DIR = os.getenv('VIDEO_DIR', os.path.join(BASE, 'uploads'))  # recordings while they are processed
 os.makedirs(FACE_DIR, exist_ok=True)
 os.makedirs(MODEL_DIR, exist_ok=True)
+os.makedirs(REPORT_DIR, exist_ok=True)
+os.makedirs(VIDEO_DIR, exist_ok=True)
 
 from dotenv import load_dotenv
 load_dotenv(os.path.join(BASE, '.env'))
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'devsecret')
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(BASE, 'db.sqlite3')
+app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///' + os.path.join(BASE, 'db.sqlite3'))
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 # Mail
 app.config['MAIL_SERVER'] = os.getenv('MAIL_SERVER')
 app.config['MAIL_PORT'] = int(os.getenv('MAIL_PORT','587'))
-app.config['MAIL_USE_TLS'] = True
+app.config['MAIL_USE_TLS'] = os.getenv('MAIL_USE_TLS','1') == '1'
+app.config['MAIL_USE_SSL'] = os.getenv('MAIL_USE_SSL','0') == '1'
 app.config['MAIL_USERNAME'] = os.getenv('MAIL_USERNAME')
 app.config['MAIL_PASSWORD'] = os.getenv('MAIL_PASSWORD')
 app.config['MAIL_DEFAULT_SENDER'] = os.getenv('MAIL_DEFAULT_SENDER', app.config['MAIL_USERNAME'])
+# Outbox: attendance mail is queued and sent in the background every
+# MAIL_OUTBOX_INTERVAL s, up to MAIL_BATCH per SMTP connection, retried with
+# exponential backoff from MAIL_RETRY_BASE s. Each sender claims its rows
+# first, so several app processes never send the same mail; a claim older
+# than MAIL_CLAIM_TIMEOUT s (the sender died) is released. MAIL_DIGEST=1 sends
+# one summary per student per day at MAIL_DIGEST_AT instead of a mail per mark.
+MAIL_OUTBOX_INTERVAL = float(os.getenv('MAIL_OUTBOX_INTERVAL','5'))
+MAIL_BATCH = int(os.getenv('MAIL_BATCH','50'))
+MAIL_MAX_ATTEMPTS = int(os.getenv('MAIL_MAX_ATTEMPTS','6'))
+MAIL_RETRY_BASE = float(os.getenv('MAIL_RETRY_BASE','30'))
+MAIL_CLAIM_TIMEOUT = float(os.getenv('MAIL_CLAIM_TIMEOUT','600'))
+MAIL_DIGEST = os.getenv('MAIL_DIGEST','0') == '1'
+MAIL_DIGEST_AT = os.getenv('MAIL_DIGEST_AT','18:00')  # HH:MM, server local time
 # Threshold
 MATCH_THRESHOLD = float(os.getenv('MATCH_THRESHOLD','0.52'))
+MATCH_AGG = os.getenv('MATCH_AGG','min')  # min | mean distance over a student's samples
+# Approximate index for large galleries: none | ivf. NPROBE trades latency for recall.
+ANN_INDEX = os.getenv('ANN_INDEX','none')
+ANN_NLIST = int(os.getenv('ANN_NLIST','0'))  # 0 = 2*sqrt(gallery size)
+ANN_NPROBE = int(os.getenv('ANN_NPROBE','8'))
+ANN_MIN_ROWS = int(os.getenv('ANN_MIN_ROWS','20000'))  # scan linearly below this
+# Gallery compaction: keep COMPACT_K diverse samples plus a centroid per
+# student, dropping samples farther than COMPACT_OUTLIER from their median
+# (see compact.py for an accuracy report before turning it on)
+GALLERY_COMPACT = os.getenv('GALLERY_COMPACT','0') == '1'
+COMPACT_K = int(os.getenv('COMPACT_K','3'))
+COMPACT_OUTLIER = float(os.getenv('COMPACT_OUTLIER','0.5'))
+# Seconds between checks for encodings saved by another process (one stat call)
+GALLERY_POLL = float(os.getenv('GALLERY_POLL','2'))
+# Inference worker processes (dlib), bounded queue depth and per-request timeout (s)
+INFERENCE_WORKERS = int(os.getenv('INFERENCE_WORKERS','0'))  # 0 = cpu count - 1
+INFERENCE_QUEUE = int(os.getenv('INFERENCE_QUEUE','0'))  # 0 = 2 per worker
+INFERENCE_TIMEOUT = float(os.getenv('INFERENCE_TIMEOUT','10'))
+# Face detection: hog | cnn | haar | opencv_dnn, run on a copy downscaled by
+# DETECT_SCALE; DETECT_MOTION searches only changed regions on streams
+DETECTOR = dict(backend=os.getenv('DETECTOR','hog'),
+                scale=float(os.getenv('DETECT_SCALE','1.0')),
+                upsample=int(os.getenv('DETECT_UPSAMPLE','1')),
+                min_face=int(os.getenv('DETECT_MIN_FACE','20')),
+                dnn_model=os.getenv('DETECT_DNN_MODEL'),
+                dnn_config=os.getenv('DETECT_DNN_CONFIG'),
+                dnn_confidence=float(os.getenv('DETECT_DNN_CONFIDENCE','0.5')))
+DETECT_MOTION = os.getenv('DETECT_MOTION','1') == '1'
+# Quality gate before any dlib work: blur (Laplacian variance at half
+# resolution), brightness and face size (px); frames within QUALITY_DEDUP
+# bits (dHash) of one the same client sent in the last QUALITY_DEDUP_TTL s
+# are skipped, and training frames within ENROLL_DEDUP bits of one another
+# are saved once
+QUALITY_GATE = os.getenv('QUALITY_GATE','1') == '1'
+QUALITY = dict(min_blur=float(os.getenv('QUALITY_MIN_BLUR','20')),
+               min_brightness=float(os.getenv('QUALITY_MIN_BRIGHTNESS','40')),
+               max_brightness=float(os.getenv('QUALITY_MAX_BRIGHTNESS','225')),
+               dedup=int(os.getenv('QUALITY_DEDUP','3')),
+               ttl=float(os.getenv('QUALITY_DEDUP_TTL','10')))
+QUALITY_MIN_FACE = int(os.getenv('QUALITY_MIN_FACE','40'))
+ENROLL_DEDUP = int(os.getenv('ENROLL_DEDUP','4'))
+# Micro-batching of /api/recognize frames across requests
+BATCH_WINDOW_MS = float(os.getenv('BATCH_WINDOW_MS','15'))
+BATCH_MAX = int(os.getenv('BATCH_MAX','8'))
+STREAM_RECENT = int(os.getenv('STREAM_RECENT','20'))  # results kept per stream connection
+# Face tracking on streams: box overlap to follow a face, frames a lost track
+# survives, and consistent identifications needed before marking
+TRACK_IOU = float(os.getenv('TRACK_IOU','0.3'))
+TRACK_MAX_MISSES = int(os.getenv('TRACK_MAX_MISSES','5'))
+TRACK_CONFIRM = int(os.getenv('TRACK_CONFIRM','1'))
+# Rows per page on the paginated JSON endpoints (default / max)
+PAGE_SIZE = int(os.getenv('PAGE_SIZE','50'))
+PAGE_MAX = int(os.getenv('PAGE_MAX','500'))
+# Seconds a cached username -> user id is trusted (users may be deleted and
+# re-created by another worker process)
+USER_ID_TTL = float(os.getenv('USER_ID_TTL','60'))
+REPORT_CHUNK = int(os.getenv('REPORT_CHUNK','5000'))  # rows fetched per cursor round trip
+# Background jobs record the process running them and refresh a heartbeat
+# every JOB_HEARTBEAT s; a queued/running job whose heartbeat is older than
+# JOB_STALE s lost its process and is marked failed
+JOB_HEARTBEAT = float(os.getenv('JOB_HEARTBEAT','15'))
+JOB_STALE = float(os.getenv('JOB_STALE','120'))
+# Offline attendance from a recorded video or a set of stills: frames are
+# sampled every VIDEO_INTERVAL s to start with, stretched up to
+# VIDEO_MAX_INTERVAL while the picture stays the same and shortened down to
+# VIDEO_MIN_INTERVAL when it changes; VIDEO_BATCH frames go to a worker at a
+# time, and a student is marked after matching in VIDEO_MIN_VOTES sampled
+# frames (one for stills). Uploads are deleted afterwards unless VIDEO_KEEP=1
+VIDEO_INTERVAL = float(os.getenv('VIDEO_INTERVAL','1'))
+VIDEO_MIN_INTERVAL = float(os.getenv('VIDEO_MIN_INTERVAL','0.25'))
+VIDEO_MAX_INTERVAL = float(os.getenv('VIDEO_MAX_INTERVAL','4'))
+VIDEO_BATCH = int(os.getenv('VIDEO_BATCH','4'))
+VIDEO_MIN_VOTES = int(os.getenv('VIDEO_MIN_VOTES','3'))
+VIDEO_KEEP = os.getenv('VIDEO_KEEP','0') == '1'
+# Recognition metrics: a JSON log line per frame, Prometheus /metrics (needs
+# METRICS_TOKEN as a bearer token, or an admin session, when set) and a
+# profiler run on a PROFILE_SAMPLE fraction of frames, written to PROFILE_DIR
+RECOGNIZE_LOG = os.getenv('RECOGNIZE_LOG','1') == '1'
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+PROFILE_SAMPLE = float(os.getenv('PROFILE_SAMPLE','0'))
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(BASE, 'profiles'))
 
 db = SQLAlchemy(app)
+
+@event.listens_for(Engine, 'connect')
+def _sqlite_pragmas(dbapi_conn, _record):
+    # WAL: dashboards reading attendance don't block the recognition writes
+    if isinstance(dbapi_conn, sqlite3.Connection):
+        cur = dbapi_conn.cursor()
+        cur.execute('PRAGMA journal_mode=WAL')
+        cur.execute('PRAGMA synchronous=NORMAL')
+        cur.execute('PRAGMA busy_timeout=5000')
+        cur.close()
 mail = Mail(app)
 socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet')
 
+def _offload():
+    # wait for worker results in a real thread so the eventlet hub keeps serving
+    if socketio.async_mode == 'eventlet':
+        from eventlet import tpool
+        return tpool.execute
+    return None
+
+Detector(**DETECTOR)  # fail at startup on a bad detector config, not in the workers
+INFERENCE = InferenceService(workers=INFERENCE_WORKERS, max_pending=INFERENCE_QUEUE,
+                             timeout=INFERENCE_TIMEOUT, offload=_offload(), detector=DETECTOR,
+                             min_face=QUALITY_MIN_FACE if QUALITY_GATE else 0)
+GATE = QualityGate(**QUALITY) if QUALITY_GATE else None
+
 # token serializer for password reset
 serializer = URLSafeTimedSerializer(app.config['SECRET_KEY'])
 
@@ -89,6 +222,8 @@ class User(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 class Attendance(db.Model):
+    __table_args__ = (db.Index('uq_attendance_user_date_subject', 'user_id', 'date', 'subject', unique=True),
+                      db.Index('ix_attendance_date', 'date'))
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     subject = db.Column(db.String(150))
@@ -103,57 +238,335 @@ class Timetable(db.Model):
     end = db.Column(db.String(5))
     subject = db.Column(db.String(120))
 
+# Attendance counts kept up to date by insert_attendance, so percentages don't
+# need a scan of the raw rows: present marks per (student, subject), and one
+# row per day a subject was held (had at least one mark)
+class AttendanceSummary(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    subject = db.Column(db.String(150), primary_key=True)
+    present = db.Column(db.Integer, default=0)
+    last_date = db.Column(db.String(20))
+
+class SubjectSession(db.Model):
+    subject = db.Column(db.String(150), primary_key=True)
+    date = db.Column(db.String(20), primary_key=True)
+
+class ReportJob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20))  # attendance | matrix
+    fmt = db.Column(db.String(10))   # csv | xlsx | parquet
+    params = db.Column(db.Text)      # JSON filters
+    status = db.Column(db.String(10), default='queued')  # queued | running | done | failed
+    rows = db.Column(db.Integer)
+    path = db.Column(db.String(300))
+    error = db.Column(db.Text)
+    requested_by = db.Column(db.Integer, db.ForeignKey('user.id'))
+    owner = db.Column(db.String(100))  # host:pid of the process running it
+    heartbeat = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+class VideoJob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(10))  # video | stills
+    source = db.Column(db.String(300))  # video file, or folder of stills
+    subject = db.Column(db.String(150))
+    recorded_at = db.Column(db.DateTime)
+    duration = db.Column(db.Float)  # s; stills: image count
+    min_votes = db.Column(db.Integer)
+    status = db.Column(db.String(10), default='queued')  # queued | running | done | failed
+    progress = db.Column(db.Float, default=0)  # 0..1
+    frames = db.Column(db.Integer, default=0)    # sampled
+    analyzed = db.Column(db.Integer, default=0)  # passed the quality gate
+    faces = db.Column(db.Integer, default=0)
+    marked = db.Column(db.Integer)
+    result = db.Column(db.Text)  # JSON: votes per student, marks, rejected frames
+    error = db.Column(db.Text)
+    requested_by = db.Column(db.Integer, db.ForeignKey('user.id'))
+    owner = db.Column(db.String(100))  # host:pid of the process running it
+    heartbeat = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+class OutboxEmail(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(200), nullable=False)
+    subject = db.Column(db.String(200))
+    template = db.Column(db.String(120))  # rendered by the sender, not the request
+    context = db.Column(db.Text)  # JSON template arguments
+    dedupe_key = db.Column(db.String(120), unique=True)  # e.g. digest:<user_id>:<date>
+    status = db.Column(db.String(10), default='pending', index=True)  # pending | sending | sent | failed
+    claimed_at = db.Column(db.DateTime)  # when a sender took it (status 'sending')
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt = db.Column(db.DateTime, default=datetime.utcnow)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+
+# columns added to existing tables since they were first created
+ADDED_COLUMNS = {'outbox_email': {'claimed_at': 'DATETIME'},
+                 'report_job': {'owner': 'VARCHAR(100)', 'heartbeat': 'DATETIME'},
+                 'video_job': {'owner': 'VARCHAR(100)', 'heartbeat': 'DATETIME'}}
+
+def upgrade_schema():
+    """Add indexes and columns that create_all does not add to existing tables."""
+    with db.engine.begin() as conn:
+        for table, columns in ADDED_COLUMNS.items():
+            have = {row[1] for row in conn.execute(text(f'PRAGMA table_info({table})'))}
+            for name, ddl in columns.items():
+                if name not in have:
+                    conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {name} {ddl}'))
+        removed = 0
+        if not conn.execute(text("SELECT 1 FROM sqlite_master WHERE name='uq_attendance_user_date_subject'")).first():
+            # keep the first mark of any duplicates so the unique index can be built;
+            # the others are moved to attendance_duplicates, not dropped
+            extra = 'FROM attendance WHERE id NOT IN (SELECT MIN(id) FROM attendance GROUP BY user_id, date, subject)'
+            removed = conn.execute(text(f'SELECT COUNT(*) {extra}')).scalar()
+            if removed:
+                conn.execute(text('CREATE TABLE IF NOT EXISTS attendance_duplicates AS SELECT * FROM attendance WHERE 0'))
+                conn.execute(text(f'INSERT INTO attendance_duplicates SELECT * {extra}'))
+                conn.execute(text(f'DELETE {extra}'))
+                app.logger.warning('moved %d duplicate attendance rows to attendance_duplicates '
+                                   '(the first mark of each student/date/subject is kept)', removed)
+        conn.execute(text('CREATE UNIQUE INDEX IF NOT EXISTS uq_attendance_user_date_subject '
+                          'ON attendance (user_id, date, subject)'))
+        conn.execute(text('CREATE INDEX IF NOT EXISTS ix_attendance_date ON attendance (date)'))
+        if removed or not conn.execute(text('SELECT 1 FROM subject_session LIMIT 1')).first():
+            rebuild_attendance_summary(conn)
+
+def rebuild_attendance_summary(conn):
+    """Recompute the summary tables from the raw attendance rows (one-off backfill)."""
+    conn.execute(text('DELETE FROM attendance_summary'))
+    conn.execute(text('DELETE FROM subject_session'))
+    conn.execute(text("INSERT INTO attendance_summary (user_id, subject, present, last_date) "
+                      "SELECT user_id, subject, COUNT(*), MAX(date) FROM attendance "
+                      "WHERE status = 'Present' AND user_id IS NOT NULL GROUP BY user_id, subject"))
+    conn.execute(text('INSERT INTO subject_session (subject, date) '
+                      'SELECT DISTINCT subject, date FROM attendance WHERE subject IS NOT NULL'))
+
 # ---------------- encodings helpers ----------------
+def encode_image(path):
+    return INFERENCE.encode_file(path)
+
 def load_encodings():
-    if not os.path.exists(ENC_FILE):
-        return {"names": [], "encodings": []}
-    with open(ENC_FILE,'r') as f:
-        data = json.load(f)
-    encs = [np.array(e) for e in data.get('encodings',[])]
-    return {"names": data.get('names',[]), "encodings": encs}
-
-def save_encodings(names, encodings):
-    data = {"names": names, "encodings":[e.tolist() for e in encodings]}
-    with open(ENC_FILE,'w') as f:
-        json.dump(data,f)
+    index = make_index(ANN_INDEX, nlist=ANN_NLIST, nprobe=ANN_NPROBE, min_rows=ANN_MIN_ROWS)
+    # lock waits yield to the eventlet hub instead of blocking the server
+    return EncodingStore(MODEL_DIR, FACE_DIR, index=index, sleep=socketio.sleep).load()
 
+# Edits run in a store transaction (locked across processes, saved as a new
+# generation); matching always uses the last published snapshot. Syncs encode
+# before locking, so a long encode never holds up other edits.
 def build_encodings_from_images():
-    names=[]; encs=[]
-    for username in os.listdir(FACE_DIR):
-        folder = os.path.join(FACE_DIR, username)
-        if not os.path.isdir(folder): continue
-        for fname in os.listdir(folder):
-            if fname.lower().endswith(('.jpg','.jpeg','.png')):
-                path = os.path.join(folder,fname)
-                try:
-                    img = face_recognition.load_image_file(path)
-                    d = face_recognition.face_encodings(img)
-                    if d:
-                        encs.append(d[0]); names.append(username)
-                except Exception as e:
-                    app.logger.warning('skip %s: %s', path, e)
-    save_encodings(names, encs)
-    return names, encs
+    """Sync the store with face_data/, encoding only new or changed images."""
+    ENC.sync_all(encode_image, app.logger)
+    if GALLERY_COMPACT:
+        with ENC.transaction():
+            ENC.compact_all(COMPACT_K, COMPACT_OUTLIER)
+    return ENC.names, ENC.encodings
+
+def sync_user_encodings(username):
+    added, removed = ENC.sync_user(username, encode_image, app.logger)
+    if GALLERY_COMPACT:
+        with ENC.transaction():
+            ENC.compact_user(username, COMPACT_K, COMPACT_OUTLIER)
+    return added, removed
+
+def remove_user_encodings(username):
+    with ENC.transaction():
+        ENC.remove_user(username)
+
+def reload_encodings():
+    """Scheduler job: pick up a generation saved by another process."""
+    if not ENC.lock.acquire(blocking=False):  # a local edit is in progress
+        return False
+    try:
+        old = ENC.generation
+        if ENC.refresh():
+            app.logger.info('encodings reloaded: generation %s -> %s, %d rows', old, ENC.generation, len(ENC))
+            return True
+        return False
+    finally:
+        ENC.lock.release()
 
 # pre-load encodings
 ENC = load_encodings()
 
+# username -> (user id, looked up at) for gallery names, filled on demand and
+# refreshed after USER_ID_TTL s; marking a frame then needs no per-name user lookup
+USER_IDS = {}
+
+def user_ids(usernames):
+    now = time.monotonic()
+    missing = [u for u in usernames if u not in USER_IDS or now - USER_IDS[u][1] > USER_ID_TTL]
+    if missing:
+        for u in missing:
+            USER_IDS.pop(u, None)
+        USER_IDS.update((u, (uid, now)) for u, uid in
+                        db.session.query(User.username, User.id).filter(User.username.in_(missing)).all())
+    return {u: USER_IDS[u][0] for u in usernames if u in USER_IDS}
+
+def match_encodings(encodings):
+    return ENC.snapshot.match_identities(encodings, k=1, agg=MATCH_AGG)
+
+BATCHER = MicroBatcher(INFERENCE, match_encodings, window_ms=BATCH_WINDOW_MS, max_batch=BATCH_MAX)
+
+# ---------------- recognition metrics ----------------
+RECOGNIZE_SECONDS = metrics.histogram('recognize_seconds', 'Time to handle one frame')
+FACES_PER_FRAME = metrics.histogram('recognize_faces_per_frame', 'Faces detected per frame', metrics.SIZE_BUCKETS)
+metrics.gauge('gallery_rows', 'Encodings in the matching gallery', lambda: len(ENC.snapshot))
+metrics.gauge('gallery_generation', 'Encoding store generation in use', lambda: ENC.generation)
+metrics.gauge('inference_pending', 'Jobs queued or running in the inference pool', lambda: INFERENCE.pending)
+metrics.gauge('recognize_batch_pending', 'Frames waiting for a micro-batch', lambda: BATCHER.pending)
+
+def observe_frame(source, subject, timer, result, status):
+    """Record one handled frame: stage histograms, counters and the log line."""
+    total = timer.elapsed()
+    RECOGNIZE_SECONDS.observe(total)
+    for stage, secs in timer.stages.items():
+        metrics.histogram('recognize_stage_seconds', 'Time per recognition stage', stage=stage).observe(secs)
+    metrics.counter('recognize_frames_total', 'Frames received', source=source).inc()
+    if result.get('ok'):
+        FACES_PER_FRAME.observe(result['faces'])
+        for outcome, n in (('matched', result['matched']), ('no_match', result['encoded'] - result['matched']),
+                           ('marked', len(result['usernames'])), ('already_marked', len(result['already_marked'])),
+                           ('too_small', result.get('small_faces', 0))):
+            metrics.counter('recognize_faces_total', 'Faces by outcome', outcome=outcome).inc(n)
+    elif result['error'] == 'rejected':
+        metrics.counter('recognize_rejected_total', 'Frames skipped by the quality gate',
+                        reason=result['reason']).inc()
+    else:
+        metrics.counter('recognize_errors_total', 'Frames not recognized', error=result['error']).inc()
+    if RECOGNIZE_LOG:
+        line = {'source': source, 'subject': subject, 'status': status, 'ms': round(total * 1000, 2),
+                'stages': timer.ms(), 'generation': ENC.generation}
+        if result.get('ok'):
+            line.update({k: result[k] for k in ('faces', 'encoded', 'matched')},
+                        marked=len(result['usernames']), already_marked=len(result['already_marked']))
+        else:
+            line['error'] = result['error']
+            if 'reason' in result:
+                line['reason'] = result['reason']
+        app.logger.info('recognize %s', json.dumps(line))
+
 # ---------------- email helper ----------------
 def send_attendance_email_to_user(user:User, att_date:str, subject_name:str):
-    if not user.email: return False
-    try:
-        msg = Message(subject=f'Attendance marked: {att_date}',
-                      recipients=[user.email])
-        msg.html = render_template('email_template.html',
-                                   username=user.username,
-                                   date=att_date,
-                                   subject=subject_name,
-                                   organization='Your Institute')
-        mail.send(msg)
-        return True
-    except Exception as e:
-        app.logger.exception('Mail send failed: %s', e)
-        return False
+    """Queue the attendance mail (sent by flush_outbox); caller commits."""
+    if not user.email or MAIL_DIGEST: return False
+    queue_email(user.email, f'Attendance marked: {att_date}', 'email_template.html',
+                dict(username=user.username,
+                     date=att_date,
+                     subject=subject_name,
+                     organization='Your Institute'))
+    return True
+
+# ---------------- email outbox ----------------
+# errors after which the SMTP connection is unusable; anything else only
+# fails the one message
+SMTP_CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, ConnectionError, TimeoutError)
+
+def queue_email(recipient, subject, template, context, dedupe_key=None):
+    db.session.add(OutboxEmail(recipient=recipient, subject=subject, template=template,
+                               context=json.dumps(context), dedupe_key=dedupe_key))
+
+def _retry_later(row, error):
+    row.attempts += 1
+    row.last_error = f'{type(error).__name__}: {error}'[:500]
+    if row.attempts >= MAIL_MAX_ATTEMPTS:
+        row.status = 'failed'
+    else:
+        row.status = 'pending'
+        delay = min(MAIL_RETRY_BASE * 2 ** (row.attempts - 1), 3600)
+        row.next_attempt = datetime.utcnow() + timedelta(seconds=delay)
+
+def claim_outbox(limit):
+    """Claim up to ``limit`` due rows for this sender; returns them.
+
+    Each row is taken with a conditional UPDATE (pending -> sending), so a
+    row another process claimed first is skipped. Claims older than
+    MAIL_CLAIM_TIMEOUT are released back to pending first.
+    """
+    now = datetime.utcnow()
+    OutboxEmail.query.filter(OutboxEmail.status == 'sending',
+                             OutboxEmail.claimed_at < now - timedelta(seconds=MAIL_CLAIM_TIMEOUT)) \
+        .update({'status': 'pending'}, synchronize_session=False)
+    due = [i for (i,) in db.session.query(OutboxEmail.id)
+           .filter(OutboxEmail.status == 'pending', OutboxEmail.next_attempt <= now)
+           .order_by(OutboxEmail.id).limit(limit)]
+    claimed = [i for i in due
+               if OutboxEmail.query.filter_by(id=i, status='pending')
+               .update({'status': 'sending', 'claimed_at': now}, synchronize_session=False)]
+    db.session.commit()
+    return OutboxEmail.query.filter(OutboxEmail.id.in_(claimed)).order_by(OutboxEmail.id).all() if claimed else []
+
+def flush_outbox(limit=None):
+    """Send due outbox mail over one SMTP connection; returns the number sent."""
+    with app.app_context():
+        if not app.config['MAIL_SERVER'] and not mail.suppress:
+            return 0  # not configured: leave the mail queued
+        rows = claim_outbox(limit or MAIL_BATCH)
+        if not rows:
+            return 0
+        left = list(rows); sent = 0
+        try:
+            with mail.connect() as conn:
+                while left:
+                    row = left[0]
+                    try:
+                        msg = Message(subject=row.subject, recipients=[row.recipient])
+                        msg.html = render_template(row.template, **json.loads(row.context or '{}'))
+                        conn.send(msg)
+                        row.status = 'sent'; row.sent_at = datetime.utcnow(); sent += 1
+                    except SMTP_CONNECTION_ERRORS:
+                        raise
+                    except Exception as e:
+                        app.logger.warning('outbox mail %s to %s failed: %s', row.id, row.recipient, e)
+                        _retry_later(row, e)
+                    left.pop(0)
+        except Exception as e:
+            app.logger.warning('outbox: SMTP connection failed, %d mails retried later: %s', len(left), e)
+            for row in left:
+                _retry_later(row, e)
+        finally:
+            db.session.commit()
+        return sent
+
+def queue_attendance_digests(day=None):
+    """Queue one summary per student marked on ``day`` (MAIL_DIGEST mode)."""
+    day = day or date.today().isoformat()
+    with app.app_context():
+        rows = (db.session.query(User, Attendance).join(Attendance, Attendance.user_id == User.id)
+                .filter(Attendance.date == day, User.email.isnot(None), User.email != '')
+                .order_by(User.id, Attendance.time).all())
+        marks = {}
+        for user, att in rows:
+            marks.setdefault(user.id, (user, []))[1].append({'subject': att.subject, 'time': att.time})
+        keys = {f'digest:{uid}:{day}' for uid in marks}
+        done = {k for (k,) in db.session.query(OutboxEmail.dedupe_key).filter(OutboxEmail.dedupe_key.in_(keys))}
+        queued = 0
+        for uid, (user, items) in marks.items():
+            key = f'digest:{uid}:{day}'
+            if key in done:
+                continue
+            queue_email(user.email, f'Attendance summary: {day}', 'email_digest.html',
+                        dict(username=user.username, date=day, marks=items, organization='Your Institute'),
+                        dedupe_key=key)
+            queued += 1
+        db.session.commit()
+        return queued
+
+scheduler = BackgroundScheduler(daemon=True)
+
+def start_background_jobs():
+    scheduler.add_job(reload_encodings, 'interval', seconds=GALLERY_POLL, id='encodings',
+                      max_instances=1, coalesce=True)
+    scheduler.add_job(flush_outbox, 'interval', seconds=MAIL_OUTBOX_INTERVAL, id='outbox',
+                      max_instances=1, coalesce=True)
+    scheduler.add_job(heartbeat_jobs, 'interval', seconds=JOB_HEARTBEAT, id='heartbeat',
+                      max_instances=1, coalesce=True)
+    if MAIL_DIGEST:
+        hour, minute = MAIL_DIGEST_AT.split(':')
+        scheduler.add_job(queue_attendance_digests, 'cron', hour=int(hour), minute=int(minute), id='digest')
+    scheduler.start()
 
 # ---------------- views ----------------
 @app.route('/')
@@ -291,11 +704,17 @@ def admin_dashboard():
     if not uid: return redirect(url_for('login'))
     u = User.query.get(uid)
     if not u or u.role!='admin': return redirect(url_for('login'))
-    students = User.query.filter_by(role='student').all()
-    attendance = Attendance.query.order_by(Attendance.date.desc()).limit(200).all()
+    return render_admin_dashboard()
+
+def render_admin_dashboard(error=None):
+    # students and attendance rows are fetched page by page from the JSON API
+    student_count = User.query.filter_by(role='student').count()
+    attendance_count = db.session.query(db.func.coalesce(db.func.sum(AttendanceSummary.present), 0)).scalar()
     timetable = Timetable.query.order_by(Timetable.day, Timetable.start).all()
     today = date.today().isoformat()
-    return render_template('admin_dashboard.html', students=students, attendance=attendance, timetable=timetable, today=today)
+    return render_template('admin_dashboard.html', student_count=student_count, attendance_count=attendance_count,
+                           timetable=timetable, today=today, page_size=PAGE_SIZE, error=error,
+                           report_formats=REPORT_FORMATS)
 
 # Add timetable entry
 @app.route('/admin/timetable/add', methods=['POST'])
@@ -327,10 +746,13 @@ def admin_upload_images():
     for f in files:
         fname = secure_filename(f.filename)
         f.save(os.path.join(folder, fname))
-    # rebuild encodings
-    build_encodings_from_images()
-    global ENC
-    ENC = load_encodings()
+    # encode only the new images
+    try:
+        sync_user_encodings(username)
+    except (InferenceBusy, InferenceTimeout, InferenceFailed) as e:
+        app.logger.warning('upload for %s: encoding failed: %s', username, e)
+        return render_admin_dashboard(error='Images saved, but encoding them failed (server busy); '
+                                            'they are encoded on the next upload or restart.')
     return redirect(url_for('admin_dashboard'))
 
 # Admin manual mark attendance
@@ -347,21 +769,16 @@ def admin_mark():
     try:
         selected_date = datetime.strptime(dt, '%Y-%m-%d').date()
         if selected_date > date.today():
-            students = User.query.filter_by(role='student').all()
-            attendance = Attendance.query.order_by(Attendance.date.desc()).limit(200).all()
-            timetable = Timetable.query.order_by(Timetable.day, Timetable.start).all()
-            return render_template('admin_dashboard.html', students=students, attendance=attendance, timetable=timetable, error='❌ Cannot mark attendance for future dates. Only today and past dates are allowed.')
+            return render_admin_dashboard(error='❌ Cannot mark attendance for future dates. Only today and past dates are allowed.')
     except ValueError:
         # Invalid date format
-        students = User.query.filter_by(role='student').all()
-        attendance = Attendance.query.order_by(Attendance.date.desc()).limit(200).all()
-        timetable = Timetable.query.order_by(Timetable.day, Timetable.start).all()
-        return render_template('admin_dashboard.html', students=students, attendance=attendance, timetable=timetable, error='❌ Invalid date format. Please use YYYY-MM-DD.')
+        return render_admin_dashboard(error='❌ Invalid date format. Please use YYYY-MM-DD.')
 
-    user = User.query.filter_by(username=username).first()
-    if user:
-        att = Attendance(user_id=user.id, subject=subj, date=dt, time=datetime.now().strftime('%H:%M:%S'), status='Present')
-        db.session.add(att)
+    ids = user_ids([username])
+    if ids:
+        # stored zero-padded: strptime also accepts '2024-3-5', which breaks date ordering and the cursors
+        insert_attendance(list(ids.values()), subj, selected_date.strftime('%Y-%m-%d'),
+                          datetime.now().strftime('%H:%M:%S'))
         db.session.commit()
     return redirect(url_for('admin_dashboard'))
 
@@ -373,20 +790,163 @@ def teacher_take_attendance():
     if not u or u.role not in ('teacher', 'admin'):
         return redirect(url_for('login'))
     # find current subject by timetable
-    todayname = datetime.today().strftime('%A')
-    nowt = datetime.now().time()
-    todays = Timetable.query.filter_by(day=todayname).all()
-    current_subject = None
-    current_subject_time = ''
-    for t in todays:
+    todays = Timetable.query.filter_by(day=datetime.today().strftime('%A')).all()
+    current = timetable_subject(datetime.now(), todays)
+    current_subject = current.subject if current else None
+    current_subject_time = f"{current.start} - {current.end}" if current else ''
+
+    return render_template('teacher_take_attendance.html', subject=current_subject or '', subject_time=current_subject_time, timetable=todays)
+
+def timetable_subject(when, entries=None):
+    """The Timetable entry running at ``when`` (a datetime), or None."""
+    if entries is None:
+        entries = Timetable.query.filter_by(day=when.strftime('%A')).all()
+    at = when.time()
+    for t in entries:
         s = datetime.strptime(t.start, '%H:%M').time()
         e = datetime.strptime(t.end, '%H:%M').time()
-        if s <= nowt <= e:
-            current_subject = t.subject
-            current_subject_time = f"{t.start} - {t.end}"
-            break
+        if s <= at <= e:
+            return t
+    return None
 
-    return render_template('teacher_take_attendance.html', subject=current_subject or '', subject_time=current_subject_time, timetable=todays)
+def insert_attendance(uids, subject, day, at):
+    """Insert Present rows for ``uids`` in one statement (caller commits).
+
+    Rows that already exist for (user, day, subject) are left alone by the
+    unique index; returns the set of user ids actually inserted.
+    """
+    if not uids:
+        return set()
+    stmt = (sqlite_insert(Attendance)
+            .values([dict(user_id=i, subject=subject, date=day, time=at, status='Present') for i in uids])
+            .on_conflict_do_nothing(index_elements=['user_id', 'date', 'subject'])
+            .returning(Attendance.user_id))
+    new = {i for (i,) in db.session.execute(stmt)}
+    if new:
+        db.session.execute(sqlite_insert(SubjectSession).values(subject=subject, date=day).on_conflict_do_nothing())
+        up = sqlite_insert(AttendanceSummary).values(
+            [dict(user_id=i, subject=subject, present=1, last_date=day) for i in new])
+        db.session.execute(up.on_conflict_do_update(
+            index_elements=['user_id', 'subject'],
+            set_={'present': AttendanceSummary.present + 1,
+                  'last_date': db.func.max(AttendanceSummary.last_date, up.excluded.last_date)}))
+    return new
+
+def mark_attendance(usernames, subject, timer=None, when=None):
+    """Mark every username present for ``subject`` today, in one commit.
+
+    ``when`` (a datetime) marks them for another day and time instead, such
+    as when a recording was made. Returns ``{username: 'marked' |
+    'already_marked' | 'unknown_user'}``; stage timings go to ``timer`` when
+    given.
+    """
+    timer = timer or metrics.Timer()
+    when = when or datetime.now()
+    today = when.date().isoformat()
+    nowt = when.strftime('%H:%M:%S')
+    usernames = list(dict.fromkeys(usernames))
+    with timer.stage('db_lookup'):
+        ids = user_ids(usernames)
+    with timer.stage('db_insert'):
+        new = insert_attendance(list(set(ids.values())), subject, today, nowt)
+    status = {u: 'unknown_user' if u not in ids else 'marked' if ids[u] in new else 'already_marked'
+              for u in usernames}
+    with timer.stage('db_lookup'):
+        marked = User.query.filter(User.id.in_(new)).all() if new else []
+    with timer.stage('email'):
+        for user in marked:
+            # queue the email in the same transaction; the outbox sender delivers it
+            send_attendance_email_to_user(user, today, subject)
+    if marked:
+        with timer.stage('commit'):
+            db.session.commit()
+    with timer.stage('emit'):
+        for user in marked:
+            # emit socket event so teacher/admin/student dashboards can update in real time
+            socketio.emit('attendance_marked', {'username': user.username, 'subject': subject, 'date': today, 'time': nowt})
+    return status
+
+def recognize_frame(img_bytes, subject, stream=None, timer=None, client=None):
+    """Detect, match and mark attendance for every face in one JPEG frame.
+
+    With a ``stream`` state (one per recognize_stream connection), faces
+    already identified in earlier frames are followed by the stream's tracker
+    and not encoded again, and a student is marked when their track is
+    confirmed; detection is limited to regions that moved. Frames the
+    quality gate rejects (blurry, too dark/bright, or a repeat of one the
+    HTTP ``client`` just sent) come back at once with the reason. Stage timings
+    (worker, batching and database) are added to ``timer``. Returns
+    ``(result dict, http status)``.
+    """
+    timer = timer or metrics.Timer()
+    tracker = stream['tracker'] if stream else None
+    if not len(ENC.snapshot):
+        return {'ok': False, 'error': 'no_known_faces'}, 200
+    if GATE is not None:
+        with timer.stage('quality'):
+            reason, stats = GATE.check(client, img_bytes)
+        if reason == 'unreadable':
+            return {'ok': False, 'error': 'bad_frame'}, 400
+        if reason:
+            return {'ok': False, 'error': 'rejected', 'reason': reason}, 200
+    # detection + encoding run in the inference worker pool, batched with
+    # frames from other requests; matches come back for every encoded face
+    try:
+        if tracker is None or not tracker.has_confirmed():
+            res = BATCHER.analyze(img_bytes, motion=stream.get('motion') if stream else None)
+            timer.add(res['timings'])
+            tracks = tracker.update(res['locations']) if tracker is not None else None
+            encoded, matches = tracks, res['matches']
+        else:
+            # detect only, then encode just the new/unconfirmed tracks
+            res = BATCHER.analyze(img_bytes, encode=False, motion=stream.get('motion'))
+            timer.add(res['timings'])
+            tracks = tracker.update(res['locations'])
+            encoded = [t for t in tracks if tracker.needs_encoding(t)]
+            matches = []
+            if encoded:
+                more = BATCHER.analyze(img_bytes, locations=[t.box for t in encoded])
+                timer.add(more['timings'])
+                matches = more['matches']
+    except InferenceBusy:
+        return {'ok': False, 'error': 'busy'}, 429
+    except InferenceTimeout:
+        return {'ok': False, 'error': 'timeout'}, 504
+    except InferenceFailed:
+        app.logger.exception('recognition failed')
+        return {'ok': False, 'error': 'inference_failed'}, 503
+    except ValueError:
+        return {'ok': False, 'error': 'bad_frame'}, 400
+    if stream is not None and 'motion' in res:
+        stream['motion'] = res['motion']
+    if GATE is not None:
+        GATE.remember(client, stats['hash'])
+    names = [top[0][0] if top and top[0][1] <= MATCH_THRESHOLD else None for top in matches]
+    if tracker is None:
+        to_mark = [n for n in names if n]
+    else:
+        to_mark = [t.identity for t, n, top in zip(encoded, names, matches)
+                   if tracker.observe(t, n, top[0][1] if top else None)]
+    status = mark_attendance(to_mark, subject, timer) if to_mark else {}
+    marked = [n for n, st in status.items() if st == 'marked']
+    already = [n for n, st in status.items() if st == 'already_marked']
+    result = {'ok': True, 'marked': bool(marked), 'usernames': marked, 'already_marked': already,
+              'faces': len(res['locations']), 'encoded': len(matches),
+              'matched': sum(1 for n in names if n), 'small_faces': res.get('small', 0)}
+    if tracker is not None:
+        result['tracks'] = [t.to_dict() for t in tracks]
+    # single-face fields kept for the polling client
+    if marked:
+        result['username'] = marked[0]
+    elif already:
+        result.update(reason='already_marked', username=already[0])
+    elif tracks and any(t.confirmed for t in tracks):
+        result['reason'] = 'tracked'  # everyone in view was identified earlier
+    elif not res['locations'] and result['small_faces']:
+        result['reason'] = 'face_too_small'
+    else:
+        result['reason'] = 'no_match'
+    return result, 200
 
 # API recognize: receives base64 frame, marks attendance if matches
 @app.route('/api/recognize', methods=['POST'])
@@ -396,39 +956,122 @@ def api_recognize():
     subject = payload.get('subject') or 'General'
     if not frame_b64:
         return jsonify({'ok': False, 'error': 'no_frame'})
-    header, data = frame_b64.split(',', 1) if ',' in frame_b64 else ('', frame_b64)
-    img_bytes = base64.b64decode(data)
-    img = Image.open(io.BytesIO(img_bytes)).convert('RGB')
-    rgb = np.array(img)  # RGB
-    face_locations = face_recognition.face_locations(rgb)
-    face_encodings = face_recognition.face_encodings(rgb, face_locations)
-    global ENC
-    if not ENC['encodings']:
-        return jsonify({'ok': False, 'error': 'no_known_faces'})
-    for enc in face_encodings:
-        dists = face_recognition.face_distance(ENC['encodings'], enc)
-        if len(dists) == 0:
-            continue
-        best = int(np.argmin(dists))
-        if dists[best] <= MATCH_THRESHOLD:
-            username = ENC['names'][best]
-            user = User.query.filter_by(username=username).first()
-            if not user:
-                continue
-            today = date.today().isoformat()
-            exists = Attendance.query.filter_by(user_id=user.id, date=today, subject=subject, status='Present').first()
-            if exists:
-                return jsonify({'ok': True, 'marked': False, 'reason': 'already_marked', 'username': username})
-            nowt = datetime.now().strftime('%H:%M:%S')
-            att = Attendance(user_id=user.id, subject=subject, date=today, time=nowt, status='Present')
-            db.session.add(att)
-            db.session.commit()
-            # emit socket event so teacher/admin/student dashboards can update in real time
-            socketio.emit('attendance_marked', {'username': username, 'subject': subject, 'date': today, 'time': nowt})
-            # send email
-            send_attendance_email_to_user(user, today, subject)
-            return jsonify({'ok': True, 'marked': True, 'username': username})
-    return jsonify({'ok': True, 'marked': False, 'reason': 'no_match'})
+    timer = metrics.Timer()
+    with metrics.sampled_profile(PROFILE_SAMPLE, PROFILE_DIR, 'recognize'):
+        with timer.stage('base64'):
+            header, data = frame_b64.split(',', 1) if ',' in frame_b64 else ('', frame_b64)
+            img_bytes = base64.b64decode(data)
+        client = f"{session.get('user_id') or request.remote_addr}:{subject}"
+        result, status = recognize_frame(img_bytes, subject, timer=timer, client=client)
+    observe_frame('http', subject, timer, result, status)
+    return jsonify(result), status
+
+# ---------------- recognize_stream (Socket.IO) ----------------
+# Teacher devices send raw binary JPEG frames; results come back as 'result'
+# events. A frame that arrives while the previous one from the same client is
+# still being processed is dropped, so latency never builds up.
+STREAM_NS = '/recognize_stream'
+STREAMS = {}  # sid -> per-connection state
+
+@socketio.on('connect', namespace=STREAM_NS)
+def stream_connect(auth=None):
+    u = User.query.get(session.get('user_id') or 0)
+    if not u or u.role not in ('teacher', 'admin'):
+        return False
+    subject = (auth or {}).get('subject') or 'General'
+    STREAMS[request.sid] = {'subject': subject, 'busy': False, 'frames': 0, 'dropped': 0,
+                            'recent': deque(maxlen=STREAM_RECENT),
+                            'tracker': FaceTracker(TRACK_IOU, TRACK_MAX_MISSES, TRACK_CONFIRM),
+                            'motion': {} if DETECT_MOTION else None}
+
+@socketio.on('disconnect', namespace=STREAM_NS)
+def stream_disconnect():
+    STREAMS.pop(request.sid, None)
+
+@socketio.on('subject', namespace=STREAM_NS)
+def stream_subject(data):
+    state = STREAMS.get(request.sid)
+    if state is not None:
+        state['subject'] = (data or {}).get('subject') or 'General'
+        state['tracker'] = FaceTracker(TRACK_IOU, TRACK_MAX_MISSES, TRACK_CONFIRM)
+
+metrics.gauge('recognize_streams', 'Open recognize_stream connections', lambda: len(STREAMS))
+
+@socketio.on('frame', namespace=STREAM_NS)
+def stream_frame(data):
+    state = STREAMS.get(request.sid)
+    if state is None or not isinstance(data, (bytes, bytearray)):
+        return
+    if state['busy']:
+        state['dropped'] += 1
+        metrics.counter('recognize_frames_dropped_total', 'Stream frames dropped while busy').inc()
+        return
+    state['busy'] = True
+    timer = metrics.Timer()
+    try:
+        with metrics.sampled_profile(PROFILE_SAMPLE, PROFILE_DIR, 'recognize_stream'):
+            # no hash dedup here: the stream's motion gate already skips static frames
+            result, status = recognize_frame(bytes(data), state['subject'], state, timer)
+    finally:
+        state['busy'] = False
+    state['frames'] += 1
+    state['recent'].append(result)
+    with timer.stage('emit'):
+        emit('result', dict(result, frames=state['frames'], dropped=state['dropped']))
+    observe_frame('stream', state['subject'], timer, result, status)
+
+# Outbox state (admin only): queue depth and recent failures
+@app.route('/admin/outbox')
+def admin_outbox():
+    uid = session.get('user_id')
+    admin = User.query.get(uid)
+    if not admin or admin.role != 'admin':
+        return jsonify({'ok': False, 'error': 'Unauthorized'})
+    counts = dict(db.session.query(OutboxEmail.status, db.func.count(OutboxEmail.id))
+                  .group_by(OutboxEmail.status).all())
+    failed = OutboxEmail.query.filter(OutboxEmail.attempts > 0, OutboxEmail.status != 'sent') \
+        .order_by(OutboxEmail.id.desc()).limit(20).all()
+    return jsonify({'ok': True, 'counts': counts, 'digest': MAIL_DIGEST,
+                    'failing': [{'id': r.id, 'recipient': r.recipient, 'status': r.status,
+                                 'attempts': r.attempts, 'error': r.last_error,
+                                 'next_attempt': r.next_attempt.isoformat()} for r in failed]})
+
+# Micro-batching stats (admin only), for tuning BATCH_WINDOW_MS against p99 latency
+@app.route('/admin/metrics/batching')
+def admin_batching_metrics():
+    uid = session.get('user_id')
+    admin = User.query.get(uid)
+    if not admin or admin.role != 'admin':
+        return jsonify({'ok': False, 'error': 'Unauthorized'})
+    names = ('recognize_batch_size', 'recognize_batch_queue_seconds', 'recognize_batch_seconds')
+    return jsonify({'ok': True, 'window_ms': BATCH_WINDOW_MS, 'max_batch': BATCH_MAX,
+                    **{n: metrics.REGISTRY[n].snapshot() for n in names}})
+
+# Recognition stage percentiles and outcome counts (admin only)
+@app.route('/admin/metrics/recognition')
+def admin_recognition_metrics():
+    uid = session.get('user_id')
+    admin = User.query.get(uid)
+    if not admin or admin.role != 'admin':
+        return jsonify({'ok': False, 'error': 'Unauthorized'})
+    return jsonify({'ok': True, 'frame': RECOGNIZE_SECONDS.snapshot(),
+                    'stages': {m.labels['stage']: m.snapshot() for m in metrics.find('recognize_stage_seconds')},
+                    'faces': {m.labels['outcome']: m.value for m in metrics.find('recognize_faces_total')},
+                    'errors': {m.labels['error']: m.value for m in metrics.find('recognize_errors_total')},
+                    'gallery_rows': len(ENC.snapshot), 'inference_pending': INFERENCE.pending,
+                    'batch_pending': BATCHER.pending})
+
+# Prometheus scrape endpoint
+@app.route('/metrics')
+def prometheus_metrics():
+    token = request.headers.get('Authorization', '')
+    if METRICS_TOKEN and not hmac.compare_digest(token.encode(), f'Bearer {METRICS_TOKEN}'.encode()):
+        admin = User.query.get(session.get('user_id') or 0)
+        if not admin or admin.role != 'admin':
+            return Response('Unauthorized\n', 401, mimetype='text/plain')
+    if 'application/openmetrics-text' in request.headers.get('Accept', ''):
+        return Response(metrics.render(openmetrics=True), mimetype=metrics.OPENMETRICS)
+    return Response(metrics.render(), mimetype=metrics.TEXT_FORMAT)
 
 # API train: accepts frames for a username, saves images and rebuilds encodings
 @app.route('/api/train', methods=['POST'])
@@ -438,20 +1081,38 @@ def api_train():
     frames = payload.get('frames', [])
     if not username or not frames:
         return jsonify({'ok': False, 'error': 'need_username_frames'})
+    data = [base64.b64decode(b64.split(',', 1)[1] if ',' in b64 else b64) for b64 in frames]
+    # drop unusable frames, and near-identical ones so the gallery only gets distinct samples
+    rejected = {}
+    if GATE is not None:
+        checked = [GATE.inspect(d) for d in data]
+        usable = [i for i, (reason, _) in enumerate(checked) if reason is None]
+        for reason, _ in checked:
+            if reason:
+                rejected[reason] = rejected.get(reason, 0) + 1
+        keep = distinct([checked[i][1]['hash'] for i in usable], ENROLL_DEDUP) if ENROLL_DEDUP else range(len(usable))
+        if len(keep) < len(usable):
+            rejected['duplicate'] = len(usable) - len(keep)
+        data = [data[usable[i]] for i in keep]
+    if not data:
+        return jsonify({'ok': False, 'error': 'no usable frames: ' +
+                        ', '.join(f'{k} {v}' for k, v in rejected.items()), 'rejected': rejected})
     folder = os.path.join(FACE_DIR, username)
     os.makedirs(folder, exist_ok=True)
     saved = 0
-    for idx, b64 in enumerate(frames):
-        h, d = b64.split(',', 1) if ',' in b64 else ('', b64)
-        data = base64.b64decode(d)
+    for idx, frame in enumerate(data):
         fname = f'{int(datetime.utcnow().timestamp()*1000)}_{idx}.jpg'
         with open(os.path.join(folder, fname), 'wb') as f:
-            f.write(data)
+            f.write(frame)
         saved += 1
-    build_encodings_from_images()
-    global ENC
-    ENC = load_encodings()
-    return jsonify({'ok':True,'saved':saved})
+    try:
+        added, _ = sync_user_encodings(username)
+    except InferenceBusy:
+        return jsonify({'ok': False, 'error': 'busy', 'saved': saved, 'rejected': rejected}), 429
+    except (InferenceTimeout, InferenceFailed):
+        app.logger.exception('training %s: encoding failed', username)
+        return jsonify({'ok': False, 'error': 'encoding_failed', 'saved': saved, 'rejected': rejected}), 503
+    return jsonify({'ok':True,'saved':saved,'encoded':added,'rejected':rejected})
 
 # list student attendance (student dashboard)
 @app.route('/student')
@@ -462,14 +1123,471 @@ def student_dashboard():
     user = User.query.get(uid)
     if user.role != 'student':
         return redirect(url_for('login'))
-    atts = Attendance.query.filter_by(user_id=user.id).order_by(Attendance.date.desc()).all()
-    return render_template('student_dashboard.html', user=user, attendance=atts)
+    # records are fetched page by page from /api/attendance
+    return render_template('student_dashboard.html', user=user, summary=attendance_percentages(user.id),
+                           page_size=PAGE_SIZE)
+
+# ---------- paginated JSON API ----------
+# Keyset pagination: each page returns ``next``, an opaque cursor for the
+# row after its last one, so deep pages cost the same as the first.
+def _page_args():
+    limit = min(max(request.args.get('limit', PAGE_SIZE, type=int), 1), PAGE_MAX)
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except ValueError:
+            cursor = None
+    return limit, cursor if isinstance(cursor, list) else None
+
+def _cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def _api_user():
+    uid = session.get('user_id')
+    return User.query.get(uid) if uid else None
+
+def attendance_percentages(user_id=None, subject=None, after=None, limit=None):
+    """Per (student, subject) present count and percentage of sessions held."""
+    held = (db.session.query(SubjectSession.subject, db.func.count().label('held'))
+            .group_by(SubjectSession.subject).subquery())
+    q = (db.session.query(AttendanceSummary, User.username, held.c.held)
+         .join(User, User.id == AttendanceSummary.user_id)
+         .outerjoin(held, held.c.subject == AttendanceSummary.subject))
+    if user_id is not None:
+        q = q.filter(AttendanceSummary.user_id == user_id)
+    if subject:
+        q = q.filter(AttendanceSummary.subject == subject)
+    if after:
+        q = q.filter(db.tuple_(AttendanceSummary.user_id, AttendanceSummary.subject) > tuple(after))
+    q = q.order_by(AttendanceSummary.user_id, AttendanceSummary.subject)
+    if limit:
+        q = q.limit(limit)
+    return [{'user_id': s.user_id, 'username': name, 'subject': s.subject, 'present': s.present,
+             'held': held_n or 0, 'percent': round(100.0 * s.present / held_n, 1) if held_n else None,
+             'last_date': s.last_date} for s, name, held_n in q]
+
+@app.route('/api/attendance')
+def api_attendance():
+    """Attendance rows, newest first. Admins may filter by user/subject/date range."""
+    u = _api_user()
+    if not u:
+        return jsonify({'ok': False, 'error': 'Unauthorized'})
+    limit, cursor = _page_args()
+    q = db.session.query(Attendance, User.username).outerjoin(User, User.id == Attendance.user_id)
+    if u.role == 'admin':
+        if request.args.get('user'):
+            q = q.filter(User.username == request.args['user'])
+    else:
+        q = q.filter(Attendance.user_id == u.id)
+    if request.args.get('subject'):
+        q = q.filter(Attendance.subject == request.args['subject'])
+    if request.args.get('from'):
+        q = q.filter(Attendance.date >= request.args['from'])
+    if request.args.get('to'):
+        q = q.filter(Attendance.date <= request.args['to'])
+    if cursor:
+        q = q.filter(db.tuple_(Attendance.date, Attendance.time, Attendance.id) < tuple(cursor))
+    rows = q.order_by(Attendance.date.desc(), Attendance.time.desc(), Attendance.id.desc()).limit(limit + 1).all()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    items = [{'id': a.id, 'username': name, 'subject': a.subject, 'date': a.date, 'time': a.time,
+              'status': a.status} for a, name in rows]
+    last = rows[-1][0] if rows else None
+    return jsonify({'ok': True, 'items': items,
+                    'next': _cursor([last.date, last.time, last.id]) if more else None})
+
+@app.route('/api/students')
+def api_students():
+    """Student accounts by username (admin only); ``q`` filters by prefix."""
+    u = _api_user()
+    if not u or u.role != 'admin':
+        return jsonify({'ok': False, 'error': 'Unauthorized'})
+    limit, cursor = _page_args()
+    q = User.query.filter_by(role='student')
+    if request.args.get('q'):
+        prefix = request.args['q'].replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        q = q.filter(User.username.like(prefix + '%', escape='\\'))
+    if cursor:
+        q = q.filter(User.username > cursor[0])
+    rows = q.order_by(User.username).limit(limit + 1).all()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    items = [{'id': s.id, 'username': s.username, 'email': s.email, 'role': s.role,
+              'email_verified': bool(s.email_verified)} for s in rows]
+    return jsonify({'ok': True, 'items': items, 'next': _cursor([rows[-1].username]) if more else None})
+
+@app.route('/api/attendance/summary')
+def api_attendance_summary():
+    """Attendance percentage per student and subject (students see their own)."""
+    u = _api_user()
+    if not u:
+        return jsonify({'ok': False, 'error': 'Unauthorized'})
+    limit, cursor = _page_args()
+    user_id = u.id
+    if u.role == 'admin':
+        user_id = None
+        if request.args.get('user'):
+            user_id = user_ids([request.args['user']]).get(request.args['user'], -1)
+    rows = attendance_percentages(user_id, request.args.get('subject'), cursor, limit + 1)
+    more = len(rows) > limit
+    rows = rows[:limit]
+    return jsonify({'ok': True, 'items': rows,
+                    'next': _cursor([rows[-1]['user_id'], rows[-1]['subject']]) if more else None})
 
 # serve face images
 @app.route('/face_data/<path:filename>')
 def face_file(filename):
     return send_from_directory(FACE_DIR, filename)
 
+# ---------- reports & exports ----------
+# Rows are read through a streaming cursor (yield_per) and written as they
+# arrive: CSV can be downloaded directly as a chunked response, and any
+# format can run as a background job whose file is downloaded when done.
+ATTENDANCE_COLUMNS = [('date', 'str'), ('time', 'str'), ('username', 'str'), ('subject', 'str'), ('status', 'str')]
+REPORT_KINDS = ('attendance', 'matrix')
+
+def report_filters(args):
+    """Validated ``from``/``to``/``subject``/``user`` filters; raises ValueError."""
+    f = {k: args.get(k) or None for k in ('from', 'to', 'subject', 'user')}
+    for k in ('from', 'to'):
+        if f[k]:
+            datetime.strptime(f[k], '%Y-%m-%d')
+    return f
+
+def _date_range(q, col, f):
+    if f['from']:
+        q = q.where(col >= f['from'])
+    if f['to']:
+        q = q.where(col <= f['to'])
+    return q
+
+def attendance_report(f):
+    """Raw attendance rows in date order."""
+    q = (db.select(Attendance.date, Attendance.time, User.username, Attendance.subject, Attendance.status)
+         .outerjoin(User, User.id == Attendance.user_id))
+    q = _date_range(q, Attendance.date, f)
+    if f['subject']:
+        q = q.where(Attendance.subject == f['subject'])
+    if f['user']:
+        q = q.where(User.username == f['user'])
+    q = q.order_by(Attendance.date, Attendance.time, Attendance.id)
+    return ATTENDANCE_COLUMNS, db.session.execute(q.execution_options(yield_per=REPORT_CHUNK))
+
+def matrix_report(f):
+    """Student x subject present counts and percentages over the range.
+
+    Subjects are those held in the range plus every timetabled subject, so
+    a subject nobody attended still gets its column.
+    """
+    if f['subject']:
+        subjects = [f['subject']]
+    else:
+        held_q = _date_range(db.select(SubjectSession.subject).distinct(), SubjectSession.date, f)
+        subjects = sorted(set(db.session.scalars(held_q)) |
+                          set(db.session.scalars(db.select(Timetable.subject).distinct())) - {None})
+    held = dict(db.session.execute(_date_range(
+        db.select(SubjectSession.subject, db.func.count()).group_by(SubjectSession.subject),
+        SubjectSession.date, f)).all())
+    marks = _date_range(db.select(Attendance.user_id, Attendance.subject, db.func.count().label('present'))
+                        .where(Attendance.status == 'Present'), Attendance.date, f)
+    marks = marks.group_by(Attendance.user_id, Attendance.subject).subquery()
+    q = (db.select(User.username, marks.c.subject, marks.c.present)
+         .outerjoin(marks, marks.c.user_id == User.id)
+         .where(User.role == 'student').order_by(User.username))
+    if f['user']:
+        q = q.where(User.username == f['user'])
+    return reports.pivot(db.session.execute(q.execution_options(yield_per=REPORT_CHUNK)), subjects, held)
+
+REPORT_BUILDERS = {'attendance': attendance_report, 'matrix': matrix_report}
+REPORT_FORMATS = reports.available()  # formats whose library is installed
+
+def _report_name(kind, f, fmt):
+    span = '_'.join(v for v in (f['from'], f['to']) if v) or 'all'
+    return f'{kind}_{span}.{fmt}'
+
+def job_owner():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+OWNED_JOBS = (ReportJob, VideoJob)  # models with owner/heartbeat columns
+
+def heartbeat_jobs():
+    """Scheduler job: refresh this process's job heartbeats, fail jobs whose process is gone."""
+    with app.app_context():
+        now = datetime.utcnow()
+        for model in OWNED_JOBS:
+            active = model.query.filter(model.status.in_(('queued', 'running')))
+            active.filter(model.owner == job_owner()).update({'heartbeat': now}, synchronize_session=False)
+            active.filter(db.or_(model.heartbeat.is_(None), model.heartbeat < now - timedelta(seconds=JOB_STALE))) \
+                .update({'status': 'failed', 'error': 'interrupted: its process stopped',
+                         'finished_at': now}, synchronize_session=False)
+        db.session.commit()
+
+def run_report_job(job_id):
+    """Scheduler job: write one ReportJob's file under REPORT_DIR."""
+    with app.app_context():
+        job = ReportJob.query.get(job_id)
+        job.status, job.owner, job.heartbeat = 'running', job_owner(), datetime.utcnow()
+        db.session.commit()
+        path = os.path.join(REPORT_DIR, f'report-{job.id}.{job.fmt}')
+        try:
+            columns, rows = REPORT_BUILDERS[job.kind](json.loads(job.params))
+            job.rows = reports.write(path + '.part', job.fmt, columns, rows)
+            os.replace(path + '.part', path)
+            job.status, job.path = 'done', path
+        except Exception as e:
+            app.logger.exception('report %s failed', job_id)
+            db.session.rollback()  # a failed query or flush leaves the session unusable
+            job = ReportJob.query.get(job_id)
+            job.status, job.error = 'failed', f'{type(e).__name__}: {e}'
+            if os.path.exists(path + '.part'):
+                os.remove(path + '.part')
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+
+def _job_dict(job):
+    return {'id': job.id, 'kind': job.kind, 'format': job.fmt, 'params': json.loads(job.params or '{}'),
+            'status': job.status, 'rows': job.rows, 'error': job.error,
+            'created_at': job.created_at.isoformat() if job.created_at else None,
+            'download': url_for('download_report', job_id=job.id) if job.status == 'done' else None}
+
+# Stream a CSV export straight to the client (admin only)
+@app.route('/admin/reports/<kind>.csv')
+def export_csv(kind):
+    uid = session.get('user_id')
+    admin = User.query.get(uid)
+    if not admin or admin.role != 'admin':
+        return jsonify({'ok': False, 'error': 'Unauthorized'})
+    if kind not in REPORT_BUILDERS:
+        return jsonify({'ok': False, 'error': 'unknown_report'}), 404
+    try:
+        f = report_filters(request.args)
+    except ValueError:
+        return jsonify({'ok': False, 'error': 'bad_date'}), 400
+    columns, rows = REPORT_BUILDERS[kind](f)
+    return Response(stream_with_context(reports.csv_stream(columns, rows, REPORT_CHUNK)), mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename={_report_name(kind, f, "csv")}'})
+
+# Queue a report in the background / list recent reports (admin only)
+@app.route('/admin/reports', methods=['GET', 'POST'])
+def admin_reports():
+    uid = session.get('user_id')
+    admin = User.query.get(uid)
+    if not admin or admin.role != 'admin':
+        return jsonify({'ok': False, 'error': 'Unauthorized'})
+    if request.method == 'GET':
+        jobs = ReportJob.query.order_by(ReportJob.id.desc()).limit(20).all()
+        return jsonify({'ok': True, 'jobs': [_job_dict(j) for j in jobs]})
+    payload = request.get_json(silent=True) or request.form
+    kind, fmt = payload.get('kind', 'attendance'), payload.get('format', 'csv')
+    if kind not in REPORT_BUILDERS or fmt not in reports.FORMATS:
+        return jsonify({'ok': False, 'error': 'unknown_report'}), 400
+    if fmt not in REPORT_FORMATS:
+        return jsonify({'ok': False, 'error': 'format_unavailable'}), 400
+    try:
+        f = report_filters(payload)
+    except ValueError:
+        return jsonify({'ok': False, 'error': 'bad_date'}), 400
+    job = ReportJob(kind=kind, fmt=fmt, params=json.dumps(f), requested_by=admin.id,
+                    owner=job_owner(), heartbeat=datetime.utcnow())
+    db.session.add(job)
+    db.session.commit()
+    scheduler.add_job(run_report_job, args=[job.id], id=f'report-{job.id}')
+    return jsonify({'ok': True, 'job': _job_dict(job)})
+
+@app.route('/admin/reports/<int:job_id>')
+def report_status(job_id):
+    uid = session.get('user_id')
+    admin = User.query.get(uid)
+    if not admin or admin.role != 'admin':
+        return jsonify({'ok': False, 'error': 'Unauthorized'})
+    job = ReportJob.query.get(job_id)
+    if not job:
+        return jsonify({'ok': False, 'error': 'not_found'}), 404
+    return jsonify({'ok': True, 'job': _job_dict(job)})
+
+@app.route('/admin/reports/<int:job_id>/download')
+def download_report(job_id):
+    uid = session.get('user_id')
+    admin = User.query.get(uid)
+    if not admin or admin.role != 'admin':
+        return redirect(url_for('login'))
+    job = ReportJob.query.get(job_id)
+    if not job or job.status != 'done' or not os.path.exists(job.path):
+        return jsonify({'ok': False, 'error': 'not_ready'}), 404
+    return send_from_directory(REPORT_DIR, os.path.basename(job.path), as_attachment=True,
+                               mimetype=reports.FORMATS[job.fmt],
+                               download_name=_report_name(job.kind, json.loads(job.params), job.fmt))
+
+# ---------------- offline attendance from recordings ----------------
+# A recorded lecture (or a set of stills) is sampled, run through the quality
+# gate, detected and encoded on the inference workers a few frames per job,
+# and matched against the gallery; each student's matches are counted across
+# frames (video.Votes) and everyone with enough votes is marked in one batch
+# at the end. Progress goes to the uploader's 'user:<id>' room as
+# 'video_progress' events.
+@socketio.on('connect')
+def user_connect(auth=None):
+    uid = session.get('user_id')
+    if uid:
+        join_room(f'user:{uid}')
+
+def _video_folder(job_id):
+    return os.path.join(VIDEO_DIR, f'video-{job_id}')
+
+def _off_hub(fn, *args):
+    # video decoding is CPU-bound: run it in a real thread so the hub keeps serving
+    return INFERENCE.offload(fn, *args) if INFERENCE.offload is not None else fn(*args)
+
+def _submit_frames(chunk):
+    while True:
+        try:
+            return INFERENCE.submit(analyze_batch, [(jpeg, None, True, None) for _, _, jpeg in chunk])
+        except InferenceBusy:  # live recognition goes first
+            socketio.sleep(0.2)
+
+def _video_job_dict(job):
+    return {'id': job.id, 'kind': job.kind, 'subject': job.subject, 'status': job.status,
+            'recorded_at': job.recorded_at.isoformat(timespec='minutes') if job.recorded_at else None,
+            'duration': job.duration, 'min_votes': job.min_votes, 'progress': round(job.progress or 0, 3),
+            'frames': job.frames, 'analyzed': job.analyzed, 'faces': job.faces, 'marked': job.marked,
+            'result': json.loads(job.result) if job.result else None, 'error': job.error,
+            'created_at': job.created_at.isoformat() if job.created_at else None}
+
+def run_video_job(job_id):
+    """Background task: take attendance from one VideoJob's recording."""
+    with app.app_context():
+        job = VideoJob.query.get(job_id)
+        job.status, job.owner, job.heartbeat = 'running', job_owner(), datetime.utcnow()
+        db.session.commit()
+        room = f'user:{job.requested_by}'
+        t0 = time.perf_counter()
+        rejected, failed = {}, 0
+        if job.kind == 'video':
+            sampled = video.sample_video(job.source, VIDEO_INTERVAL, VIDEO_MIN_INTERVAL, VIDEO_MAX_INTERVAL)
+        else:
+            sampled = video.read_stills(video.list_stills(job.source))
+        frames = video.encode_frames(sampled, GATE, rejected)
+        votes = video.Votes(MATCH_THRESHOLD)
+        # leave half the pool to live recognition
+        window = max(1, INFERENCE.workers // 2)
+        try:
+            inflight, exhausted = deque(), False
+            while True:
+                while not exhausted and len(inflight) < window:
+                    chunk = []
+                    while len(chunk) < VIDEO_BATCH:
+                        item = _off_hub(next, frames, None)
+                        if item is None:
+                            exhausted = True
+                            break
+                        chunk.append(item)
+                    if chunk:
+                        inflight.append((_submit_frames(chunk), chunk))
+                if not inflight:
+                    break
+                fut, chunk = inflight.popleft()
+                raw = INFERENCE.result(fut, INFERENCE_TIMEOUT * len(chunk))
+                pairs = [(c, r) for c, r in zip(chunk, raw) if 'error' not in r]
+                encs = [r['encodings'] for _, r in pairs]
+                matches = match_encodings(np.concatenate(encs)) if sum(map(len, encs)) else []
+                start = 0
+                for (index, t, _), r in pairs:
+                    votes.add(matches[start:start + len(r['encodings'])], t)
+                    start += len(r['encodings'])
+                    job.faces += len(r['locations'])
+                job.analyzed += len(pairs)
+                failed += sum(1 for r in raw if 'error' in r)
+                job.frames = job.analyzed + failed + sum(rejected.values())
+                index, t, _ = chunk[-1]
+                job.progress = min(1.0, (t / job.duration if t is not None else (index + 1) / job.duration)
+                                   if job.duration else 0)
+                db.session.commit()
+                socketio.emit('video_progress', _video_job_dict(job), to=room)
+                socketio.sleep(0)
+            job.frames = job.analyzed + failed + sum(rejected.values())
+            accepted, details = votes.result(job.min_votes)
+            status = mark_attendance(accepted, job.subject, when=job.recorded_at) if accepted else {}
+            job.marked = sum(1 for st in status.values() if st == 'marked')
+            job.result = json.dumps({'students': details, 'status': status, 'rejected': rejected, 'failed': failed,
+                                     'too_few_frames': votes.too_few_frames(job.min_votes),
+                                     'seconds': round(time.perf_counter() - t0, 2)})
+            job.status, job.progress = 'done', 1.0
+        except Exception as e:
+            app.logger.exception('video job %s failed', job_id)
+            # the session may be mid-flush (a failed commit); start clean from the last committed progress
+            db.session.rollback()
+            job = VideoJob.query.get(job_id)
+            job.status, job.error = 'failed', f'{type(e).__name__}: {e}'
+        finally:
+            frames.close()
+        metrics.counter('video_frames_total', 'Recorded frames by outcome', outcome='analyzed').inc(job.analyzed)
+        for reason, n in rejected.items():
+            metrics.counter('video_frames_total', 'Recorded frames by outcome', outcome=reason).inc(n)
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+        if not VIDEO_KEEP:
+            shutil.rmtree(_video_folder(job.id), ignore_errors=True)
+        socketio.emit('video_progress', _video_job_dict(job), to=room)
+
+# Upload a recording (one 'video' file, or several 'images'); the subject
+# defaults to the timetable entry at the middle of the recording
+@app.route('/teacher/video', methods=['POST'])
+def teacher_video():
+    uid = session.get('user_id')
+    u = User.query.get(uid)
+    if not u or u.role not in ('teacher', 'admin'):
+        return jsonify({'ok': False, 'error': 'Unauthorized'})
+    upload = request.files.get('video')
+    upload = upload if upload and upload.filename else None
+    stills = [f for f in request.files.getlist('images') if f.filename]
+    if not upload and not stills:
+        return jsonify({'ok': False, 'error': 'no_file'}), 400
+    try:
+        recorded = request.form.get('recorded_at')
+        recorded = datetime.strptime(recorded, '%Y-%m-%dT%H:%M') if recorded else datetime.now()
+    except ValueError:
+        return jsonify({'ok': False, 'error': 'bad_date'}), 400
+    job = VideoJob(kind='video' if upload else 'stills', recorded_at=recorded, requested_by=u.id,
+                   owner=job_owner(), heartbeat=datetime.utcnow())
+    db.session.add(job)
+    db.session.flush()  # the id names the upload folder
+    folder = _video_folder(job.id)
+    os.makedirs(folder, exist_ok=True)
+    if upload:
+        job.source = os.path.join(folder, secure_filename(upload.filename) or 'video')
+        upload.save(job.source)
+        try:
+            job.duration = video.probe(job.source)[2]
+        except ValueError:
+            db.session.rollback()
+            shutil.rmtree(folder, ignore_errors=True)
+            return jsonify({'ok': False, 'error': 'bad_video'}), 400
+        middle = recorded + timedelta(seconds=job.duration / 2)
+    else:
+        for i, f in enumerate(stills):
+            f.save(os.path.join(folder, f'{i:05d}_{secure_filename(f.filename)}'))
+        job.source = folder
+        job.duration = len(video.list_stills(folder))
+        middle = recorded
+    current = timetable_subject(middle)
+    job.subject = request.form.get('subject') or (current.subject if current else 'General')
+    job.min_votes = request.form.get('min_votes', type=int) or (VIDEO_MIN_VOTES if upload else 1)
+    db.session.commit()
+    socketio.start_background_task(run_video_job, job.id)
+    return jsonify({'ok': True, 'job': _video_job_dict(job)})
+
+@app.route('/teacher/video/<int:job_id>')
+def video_status(job_id):
+    uid = session.get('user_id')
+    u = User.query.get(uid)
+    if not u or u.role not in ('teacher', 'admin'):
+        return jsonify({'ok': False, 'error': 'Unauthorized'})
+    job = VideoJob.query.get(job_id)
+    if not job or (job.requested_by != u.id and u.role != 'admin'):
+        return jsonify({'ok': False, 'error': 'not_found'}), 404
+    return jsonify({'ok': True, 'job': _video_job_dict(job)})
+
 # Delete user (admin only)
 @app.route('/admin/delete_user/<int:user_id>', methods=['POST'])
 def delete_user(user_id):
@@ -486,6 +1604,7 @@ def delete_user(user_id):
         
         # Delete all attendance records for this user
         Attendance.query.filter_by(user_id=user_id).delete()
+        AttendanceSummary.query.filter_by(user_id=user_id).delete()
         
         # Delete user face data from filesystem
         user_folder = os.path.join(FACE_DIR, user.username)
@@ -496,24 +1615,29 @@ def delete_user(user_id):
         # Delete user from database
         db.session.delete(user)
         db.session.commit()
+        USER_IDS.pop(user.username, None)
         
-        # Rebuild encodings
-        build_encodings_from_images()
-        global ENC
-        ENC = load_encodings()
+        # Drop this user's encodings
+        remove_user_encodings(user.username)
         
         return jsonify({'ok': True, 'message': f'User {user.username} deleted successfully'})
     
     return jsonify({'ok': False, 'error': 'User not found'})
 
 # ---------- init & run -------------
-with app.app_context():
-    db.create_all()
-    # initial build encodings if not exist
-    enc = load_encodings()
-    if not enc['encodings']:
-        build_encodings_from_images()
-        ENC = load_encodings()
+# APP_STARTUP=0 skips the startup build and worker pool (enroll.py imports the app)
+if __name__ != '__mp_main__' and os.getenv('APP_STARTUP','1') == '1':  # nor in a spawned worker
+    with app.app_context():
+        db.create_all()
+        upgrade_schema()
+        # initial build encodings if not exist
+        if not len(ENC):
+            build_encodings_from_images()
+        user_ids(set(ENC.names))
+        # jobs whose process stopped won't resume; other live processes keep theirs
+        heartbeat_jobs()
+    INFERENCE.start()
+    start_background_jobs()  # after the fork, so workers don't inherit its thread
 
 if __name__ == '__main__':
     # use socketio server (eventlet)
@@ -0,0 +1,166 @@
+"""Cross-request micro-batching for recognition frames.
+
+Frames submitted within ``window_ms`` of the first one (or until
+``max_batch`` frames are waiting) are dispatched together: the batch is split
+into one chunk per inference worker, and once every chunk is back all faces
+of all frames are matched against the gallery in one vectorized call, and
+each waiting request gets its own slice of the results.
+
+A frame that does not decode fails with :class:`inference.BadFrame` (a
+ValueError); a broken pool, a crashed worker or a matching error fails with
+:class:`inference.InferenceFailed`.
+
+The queueing delay (submit -> dispatch) and batch size are recorded in
+:mod:`metrics` so the window can be tuned against p99 latency; each result's
+``timings`` also gets its own ``queue`` wait and the batch's ``match`` time.
+"""
+import time, queue, threading
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+import numpy as np
+
+from inference import InferenceBusy, InferenceTimeout, InferenceFailed, BadFrame, analyze_batch
+import metrics
+
+BATCH_SIZE = metrics.histogram('recognize_batch_size', 'Frames per micro-batch', metrics.SIZE_BUCKETS)
+QUEUE_DELAY = metrics.histogram('recognize_batch_queue_seconds', 'Wait before a frame is dispatched')
+BATCH_SECONDS = metrics.histogram('recognize_batch_seconds', 'Inference plus matching time per batch')
+
+
+class _Job:
+    __slots__ = ('image', 'locations', 'encode', 'motion', 'future', 'queued', 'waited', 'result')
+
+    def __init__(self, image, locations, encode, motion):
+        self.image = image; self.locations = locations; self.encode = encode; self.motion = motion
+        self.future = Future(); self.result = None; self.waited = 0.0
+        self.queued = time.perf_counter()
+
+
+class MicroBatcher:
+    """Collects frames and runs them through ``service`` in batches.
+
+    ``match`` takes an ``(F, 128)`` array of every encoding in the batch and
+    returns one match list per row (see ``Gallery.match_identities``).
+    Results are the worker's ``analyze`` dict plus ``matches``.
+    """
+
+    def __init__(self, service, match, window_ms=20, max_batch=8, max_pending=None):
+        self.service = service
+        self.match = match
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self.max_pending = max_pending or 4 * max_batch
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def pending(self):
+        """Frames waiting to be dispatched."""
+        return self._queue.qsize()
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._collect, name='micro-batcher', daemon=True)
+                self._thread.start()
+
+    def submit(self, image, locations=None, encode=True, motion=None):
+        """Queue one frame; returns a Future for its result."""
+        if self._queue.qsize() >= self.max_pending:
+            raise InferenceBusy(f'{self._queue.qsize()} frames waiting for a batch')
+        self._ensure_thread()
+        job = _Job(image, locations, encode, motion)
+        self._queue.put(job)
+        return job.future
+
+    def analyze(self, image, locations=None, encode=True, motion=None, timeout=None):
+        fut = self.submit(image, locations, encode, motion)
+        timeout = self.service.timeout if timeout is None else timeout
+        try:
+            if self.service.offload is not None:
+                return self.service.offload(fut.result, timeout)
+            return fut.result(timeout)
+        except FutureTimeout:
+            raise InferenceTimeout(f'recognition took longer than {timeout}s')
+
+    # ---------- collector thread ----------
+    def _collect(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = batch[0].queued + self.window
+            while len(batch) < self.max_batch:
+                left = deadline - time.perf_counter()
+                if left <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=left))
+                except queue.Empty:
+                    break
+            self._dispatch(batch)
+
+    def _dispatch(self, batch):
+        now = time.perf_counter()
+        for job in batch:
+            job.waited = now - job.queued
+            QUEUE_DELAY.observe(job.waited)
+        BATCH_SIZE.observe(len(batch))
+        parts = max(1, min(self.service.workers, len(batch)))
+        chunks = [batch[i::parts] for i in range(parts)]
+        left = [len(chunks)]
+        lock = threading.Lock()
+
+        def chunk_finished():
+            with lock:
+                left[0] -= 1
+                last = left[0] == 0
+            if last:
+                self._finish(batch, now)
+
+        def chunk_done(chunk, fut):
+            try:
+                results = fut.result()
+            except Exception as e:  # the pool or the worker process, not the frames
+                results = [{'error': f'{type(e).__name__}: {e}'} for _ in chunk]
+            for job, res in zip(chunk, results):
+                job.result = res
+            chunk_finished()
+
+        for chunk in chunks:
+            try:
+                fut = self.service.submit(analyze_batch, [(j.image, j.locations, j.encode, j.motion) for j in chunk])
+            except Exception as e:  # pool saturated or broken: fail just this chunk
+                if not isinstance(e, InferenceBusy):
+                    e = InferenceFailed(f'{type(e).__name__}: {e}')
+                for job in chunk:
+                    job.future.set_exception(e)
+                chunk_finished()
+                continue
+            fut.add_done_callback(lambda f, c=chunk: chunk_done(c, f))
+
+    def _finish(self, batch, started):
+        batch = [j for j in batch if not j.future.done()]
+        results = [j.result for j in batch]
+        encs = [r['encodings'] for r in results if 'encodings' in r and len(r['encodings'])]
+        matches = []
+        t0 = time.perf_counter()
+        if encs:
+            try:
+                matches = self.match(np.concatenate(encs))
+            except Exception as e:
+                for job in batch:
+                    job.future.set_exception(InferenceFailed(f'matching failed: {type(e).__name__}: {e}'))
+                return
+        matched = time.perf_counter() - t0
+        pos = 0
+        for job, res in zip(batch, results):
+            res.setdefault('timings', {}).update(queue=job.waited, match=matched)
+            n = len(res.get('encodings', ()))
+            res['matches'] = matches[pos:pos + n]
+            pos += n
+            if res.get('bad_frame'):
+                job.future.set_exception(BadFrame(res['error']))
+            elif 'error' in res:
+                job.future.set_exception(InferenceFailed(res['error']))
+            else:
+                job.future.set_result(res)
+        BATCH_SECONDS.observe(time.perf_counter() - started)
@@ -0,0 +1,84 @@
+"""Recall and latency of the IVF index against the exact linear matcher.
+
+Builds a synthetic gallery (``--identities`` students x ``--samples`` each,
+spread like dlib encodings: ~1.0 between students, ~0.3 within one), then
+matches batches of classroom-sized queries with the exact scan and with the
+index at several ``nprobe`` settings.
+
+    python benchmarks/ann_recall.py --identities 50000 --samples 10
+"""
+import os, sys, json, time, argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from gallery import Gallery, DIM
+from ann_index import IVFIndex
+
+
+def synthetic_gallery(identities, samples, rng, spread=0.065, noise=0.02):
+    centers = rng.normal(0, spread, (identities, DIM)).astype(np.float32)
+    encs = np.repeat(centers, samples, axis=0)
+    encs += rng.normal(0, noise, encs.shape).astype(np.float32)
+    names = [f's{i}' for i in range(identities) for _ in range(samples)]
+    return centers, encs, names
+
+
+def timed(fn, repeat):
+    best = float('inf'); out = None
+    for _ in range(repeat):
+        t = time.perf_counter(); out = fn(); best = min(best, time.perf_counter() - t)
+    return out, best
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    ap.add_argument('--identities', type=int, default=20000)
+    ap.add_argument('--samples', type=int, default=10)
+    ap.add_argument('--batch', type=int, default=30, help='faces per frame')
+    ap.add_argument('--frames', type=int, default=10)
+    ap.add_argument('--nlist', type=int, default=0)
+    ap.add_argument('--nprobe', default='4,8,16,32')
+    ap.add_argument('--threshold', type=float, default=0.52)
+    ap.add_argument('--seed', type=int, default=0)
+    ap.add_argument('--json', help='write results to this file')
+    args = ap.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    centers, encs, names = synthetic_gallery(args.identities, args.samples, rng)
+    truth = rng.integers(0, args.identities, args.batch * args.frames)
+    queries = centers[truth] + rng.normal(0, 0.02, (len(truth), DIM)).astype(np.float32)
+    frames = queries.reshape(args.frames, args.batch, DIM)
+
+    exact = Gallery(encs, names)
+    ref, t_exact = timed(lambda: [exact.match_identities(f) for f in frames], 3)
+    ref = [r[0] for fr in ref for r in fr]
+    print(f'gallery {len(exact)} rows, {args.frames} frames x {args.batch} faces')
+    print(f'exact   {1000 * t_exact / args.frames:8.2f} ms/frame')
+
+    index = IVFIndex(nlist=args.nlist, min_rows=0)
+    _, t_fit = timed(lambda: index.fit(encs), 1)
+    print(f'ivf fit {t_fit:8.2f} s  nlist={len(index.centroids)}')
+    approx = Gallery(encs, names, index=index)
+    results = {'rows': len(exact), 'batch': args.batch, 'frames': args.frames,
+               'exact_ms_per_frame': 1000 * t_exact / args.frames, 'fit_s': t_fit,
+               'nlist': int(len(index.centroids)), 'ivf': []}
+    for nprobe in [int(p) for p in args.nprobe.split(',')]:
+        index.nprobe = nprobe
+        got, t = timed(lambda: [approx.match_identities(f) for f in frames], 3)
+        got = [r[0] if r else (None, float('inf')) for fr in got for r in fr]
+        recall = np.mean([g[0] == r[0] for g, r in zip(got, ref)])
+        # same accept/reject decision and identity once MATCH_THRESHOLD is applied
+        agree = np.mean([(g[1] <= args.threshold and g[0]) == (r[1] <= args.threshold and r[0])
+                         for g, r in zip(got, ref)])
+        ms = 1000 * t / args.frames
+        print(f'nprobe {nprobe:3d} {ms:8.2f} ms/frame  recall@1 {recall:.4f}  '
+              f'threshold agreement {agree:.4f}  speedup {t_exact / t:5.1f}x')
+        results['ivf'].append({'nprobe': nprobe, 'ms_per_frame': ms, 'recall_at_1': float(recall),
+                               'threshold_agreement': float(agree)})
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
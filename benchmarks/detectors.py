@@ -0,0 +1,73 @@
+"""Speed and agreement of the detection backends on our own face images.
+
+Every backend/scale combination is run over the images in ``face_data/``
+(or the folders given) and compared with full-resolution dlib HOG as the
+reference: a reference face counts as found when a detected box overlaps it
+with IoU >= 0.5.
+
+    python benchmarks/detectors.py --backends hog,haar --scales 1,0.5,0.25
+"""
+import os, sys, json, time, argparse
+import numpy as np
+
+BASE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE)
+from detection import Detector
+from tracking import iou_matrix
+from encoding_store import IMAGE_EXTS
+
+
+def images(folders):
+    for folder in folders:
+        for root, _, files in os.walk(folder):
+            for f in sorted(files):
+                if f.lower().endswith(IMAGE_EXTS):
+                    yield os.path.join(root, f)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    ap.add_argument('folders', nargs='*', default=[os.path.join(BASE, 'face_data')])
+    ap.add_argument('--backends', default='hog,haar')
+    ap.add_argument('--scales', default='1,0.5,0.25')
+    ap.add_argument('--upsample', type=int, default=1)
+    ap.add_argument('--dnn-model'); ap.add_argument('--dnn-config')
+    ap.add_argument('--json', help='write results to this file')
+    args = ap.parse_args()
+
+    from PIL import Image
+    frames = [np.array(Image.open(p).convert('RGB')) for p in images(args.folders)]
+    if not frames:
+        sys.exit('no images found')
+    ref = Detector('hog', 1.0, args.upsample)
+    truth = [ref.detect(f)[0] for f in frames]
+    n_ref = sum(len(t) for t in truth)
+    print(f'{len(frames)} images, {n_ref} reference faces (hog, full resolution)')
+    rows = []
+    for backend in args.backends.split(','):
+        for scale in [float(s) for s in args.scales.split(',')]:
+            det = Detector(backend, scale, args.upsample, dnn_model=args.dnn_model, dnn_config=args.dnn_config)
+            det.detect(frames[0])  # load models outside the timing
+            found = extra = 0; times = []
+            for f, t in zip(frames, truth):
+                t0 = time.perf_counter()
+                boxes = det.detect(f)[0]
+                times.append(time.perf_counter() - t0)
+                if t and boxes:
+                    hit = iou_matrix(t, boxes) >= 0.5
+                    found += int(hit.any(axis=1).sum()); extra += int((~hit.any(axis=0)).sum())
+                else:
+                    extra += len(boxes)
+            row = {'backend': backend, 'scale': scale, 'ms_mean': 1000 * float(np.mean(times)),
+                   'ms_p95': 1000 * float(np.percentile(times, 95)),
+                   'recall': found / n_ref if n_ref else 0.0, 'extra_boxes': extra}
+            rows.append(row)
+            print(f"{backend:10s} scale {scale:4.2f}  {row['ms_mean']:8.1f} ms  p95 {row['ms_p95']:8.1f} ms  "
+                  f"recall {row['recall']:.3f}  extra boxes {extra}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+"""End-to-end and per-stage timings of the recognition and enrollment pipelines.
+
+Runs offline on CPU against a throwaway database and model directory; the
+images come from ``face_data/`` (read only). In order it measures:
+
+``stages``   decode / detection / encoding of every image, in-process
+``build``    ``build_encodings_from_images`` from an empty store (cold) and
+             again with nothing changed (warm)
+``scales``   for each gallery size the real encodings are topped up with
+             synthetic identities (see ann_recall.py), then: store save, a
+             fresh ``load()``, matching, and ``/api/recognize`` latency and
+             throughput through the Flask test client with ``--clients``
+             concurrent senders
+
+Results go to ``--json`` (machine details and settings included) and two
+result files can be compared:
+
+    python benchmarks/pipeline.py --scales 1000,10000,100000 --json bench.json
+    python benchmarks/pipeline.py --compare before.json bench.json
+
+Client threads wait on inference results directly (no eventlet tpool), and
+no mail is sent: attendance mail only lands in the outbox table. The images
+are sent over and over from one client address, so the quality gate's
+repeat check is off (QUALITY_DEDUP=0); frames it still rejects are reported
+apart and not timed.
+"""
+import os, sys, json, time, base64, shutil, argparse, platform, tempfile, subprocess, threading
+from datetime import datetime
+import numpy as np
+
+BASE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE)
+from ann_recall import synthetic_gallery
+from encoding_store import IMAGE_EXTS
+
+
+def summary(seconds):
+    s = np.asarray(seconds, dtype=float) * 1000
+    if not len(s):
+        return {'n': 0}
+    return {'n': int(len(s)), 'mean_ms': float(s.mean()), 'p50_ms': float(np.percentile(s, 50)),
+            'p95_ms': float(np.percentile(s, 95)), 'p99_ms': float(np.percentile(s, 99))}
+
+
+def images(face_dir):
+    for root, _, files in os.walk(face_dir):
+        for f in sorted(files):
+            if f.lower().endswith(IMAGE_EXTS):
+                yield os.path.join(root, f)
+
+
+def environment(args, webapp):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE, capture_output=True,
+                                text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'time': datetime.now().isoformat(timespec='seconds'), 'commit': commit,
+            'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+            'cpus': os.cpu_count(), 'workers': webapp.INFERENCE.workers, 'detector': webapp.DETECTOR,
+            'match_threshold': webapp.MATCH_THRESHOLD, 'match_agg': webapp.MATCH_AGG,
+            'ann_index': webapp.ANN_INDEX, 'args': vars(args)}
+
+
+# ---------- stages ----------
+def bench_stages(webapp, frames, repeat):
+    """Worker stage timings (decode, detector, encode) per image, in-process."""
+    import inference
+    inference._init_worker(webapp.DETECTOR, webapp.INFERENCE.min_face)
+    inference.analyze(frames[0])  # load the dlib models outside the timing
+    stages = {}
+    for _ in range(repeat):
+        for img in frames:
+            for stage, secs in inference.analyze(img)['timings'].items():
+                stages.setdefault(stage, []).append(secs)
+    return {stage: summary(v) for stage, v in stages.items()}
+
+
+def query_batch(encs, faces, rng):
+    """``faces`` real encodings (with a little noise) standing in for one frame."""
+    picks = encs[rng.integers(0, len(encs), faces)]
+    return (picks + rng.normal(0, 0.01, picks.shape)).astype(np.float32)
+
+
+def bench_match(webapp, encs, faces, repeat, rng):
+    out = {}
+    for n in sorted({1, faces}):
+        batches = [query_batch(encs, n, rng) for _ in range(repeat)]
+        webapp.match_encodings(batches[0])
+        times = []
+        for q in batches:
+            t0 = time.perf_counter(); webapp.match_encodings(q); times.append(time.perf_counter() - t0)
+        out[f'{n}_faces'] = summary(times)
+    return out
+
+
+# ---------- build / load ----------
+def bench_build(webapp):
+    t0 = time.perf_counter(); webapp.build_encodings_from_images(); cold = time.perf_counter() - t0
+    t0 = time.perf_counter(); webapp.build_encodings_from_images(); warm = time.perf_counter() - t0
+    return {'images': sum(1 for _ in images(webapp.FACE_DIR)), 'rows': len(webapp.ENC),
+            'skipped': len(webapp.ENC.skipped), 'cold_s': cold, 'warm_s': warm}
+
+
+def grow_gallery(webapp, identities, samples, rng):
+    """Add synthetic identities until the store has ``identities`` of them."""
+    writer = webapp.load_encodings()
+    have = sum(1 for n in set(writer.names) if n.startswith('synthetic'))
+    add = identities - have
+    if add > 0:
+        _, encs, names = synthetic_gallery(add, samples, rng)
+        names = [f'synthetic{have + int(n[1:])}' for n in names]
+        by_user = {}
+        for i, (name, enc) in enumerate(zip(names, encs)):
+            by_user.setdefault(name, []).append((f'{name}/{i}.jpg', [0, 0], '', enc, None))
+        with writer.transaction():
+            for name, rows in by_user.items():
+                writer.add_results(name, rows)
+            t0 = time.perf_counter()
+        save = time.perf_counter() - t0  # the transaction saves on exit
+    else:
+        save = 0.0
+    loads = []
+    for _ in range(3):
+        t0 = time.perf_counter(); webapp.load_encodings(); loads.append(time.perf_counter() - t0)
+    t0 = time.perf_counter(); webapp.reload_encodings(); reload = time.perf_counter() - t0
+    return {'rows': len(webapp.ENC.snapshot), 'save_s': save, 'load_s': min(loads), 'reload_s': reload}
+
+
+# ---------- /api/recognize ----------
+def bench_recognize(webapp, payloads, clients, requests):
+    """Latency and throughput of ``requests`` POSTs spread over ``clients`` threads.
+
+    Frames the quality gate rejects are counted by reason under ``rejected``
+    and left out of the latency figures.
+    """
+    latencies, codes, rejected, lock = [], {}, {}, threading.Lock()
+    todo = iter(range(requests))
+
+    def client():
+        c = webapp.app.test_client()
+        while True:
+            with lock:
+                i = next(todo, None)
+            if i is None:
+                return
+            t0 = time.perf_counter()
+            r = c.post('/api/recognize', json=payloads[i % len(payloads)])
+            dt = time.perf_counter() - t0
+            body = r.get_json(silent=True) or {}
+            with lock:
+                if body.get('error') == 'rejected':
+                    rejected[body['reason']] = rejected.get(body['reason'], 0) + 1
+                    continue
+                key = str(r.status_code) if body.get('ok') else body.get('error', str(r.status_code))
+                latencies.append(dt); codes[key] = codes.get(key, 0) + 1
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - t0
+    return dict(summary(latencies), clients=clients, frames_per_s=len(latencies) / wall, results=codes,
+                rejected=rejected)
+
+
+# ---------- compare ----------
+def flatten(d, prefix=''):
+    out = {}
+    if isinstance(d, dict):
+        for k, v in d.items():
+            out.update(flatten(v, f'{prefix}.{k}' if prefix else str(k)))
+    elif isinstance(d, list):
+        for v in d:
+            key = v.get('identities', len(out)) if isinstance(v, dict) else len(out)
+            out.update(flatten(v, f'{prefix}[{key}]'))
+    elif isinstance(d, (int, float)) and not isinstance(d, bool):
+        out[prefix] = d
+    return out
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = flatten({k: v for k, v in json.load(f).items() if k != 'env'})
+    with open(new_path) as f:
+        new = flatten({k: v for k, v in json.load(f).items() if k != 'env'})
+    for key in sorted(set(old) & set(new)):
+        if not (key.endswith('_ms') or key.endswith('_s') or key.endswith('per_s')):
+            continue
+        a, b = old[key], new[key]
+        change = (b - a) / a * 100 if a else float('inf')
+        better = change < 0 if not key.endswith('per_s') else change > 0
+        mark = ' ' if abs(change) < 5 else ('+' if better else '-')
+        print(f'{mark} {key:55s} {a:12.3f} -> {b:12.3f}  {change:+7.1f}%')
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    ap.add_argument('--face-dir', default=os.path.join(BASE, 'face_data'))
+    ap.add_argument('--scales', default='1000,10000,100000', help='synthetic identities per run')
+    ap.add_argument('--samples', type=int, default=1, help='encodings per synthetic identity')
+    ap.add_argument('--faces', type=int, default=30, help='faces per frame for the matching benchmark')
+    ap.add_argument('--requests', type=int, default=60, help='/api/recognize calls per scale')
+    ap.add_argument('--clients', type=int, default=4)
+    ap.add_argument('--repeat', type=int, default=3, help='passes over the images for stage timings')
+    ap.add_argument('--seed', type=int, default=0)
+    ap.add_argument('--json', help='write results to this file')
+    ap.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files and exit')
+    args = ap.parse_args()
+    if args.compare:
+        return compare(*args.compare)
+
+    tmp = tempfile.mkdtemp(prefix='face-bench-')
+    os.environ.update(FACE_DIR=os.path.abspath(args.face_dir), MODEL_DIR=os.path.join(tmp, 'models'),
+                      REPORT_DIR=os.path.join(tmp, 'reports'),
+                      DATABASE_URL='sqlite:///' + os.path.join(tmp, 'db.sqlite3'),
+                      APP_STARTUP='0', RECOGNIZE_LOG='0', MAIL_SERVER='', QUALITY_DEDUP='0')
+    try:
+        import app as webapp
+        webapp.INFERENCE.offload = None  # plain threads, not eventlet
+        rng = np.random.default_rng(args.seed)
+        paths = list(images(webapp.FACE_DIR))
+        if not paths:
+            sys.exit(f'no images under {webapp.FACE_DIR}')
+        frames = [open(p, 'rb').read() for p in paths]
+        payloads = [{'frame': 'data:image/jpeg;base64,' + base64.b64encode(f).decode(), 'subject': 'Benchmark'}
+                    for f in frames]
+        with webapp.app.app_context():
+            webapp.db.create_all()
+            webapp.upgrade_schema()
+            for username in sorted(os.listdir(webapp.FACE_DIR)):
+                if os.path.isdir(os.path.join(webapp.FACE_DIR, username)):
+                    webapp.db.session.add(webapp.User(username=username, password='bench', role='student'))
+            webapp.db.session.commit()
+        webapp.INFERENCE.start()
+        results = {'env': environment(args, webapp)}
+        print(f'{len(frames)} images, {webapp.INFERENCE.workers} inference workers')
+
+        results['build'] = bench_build(webapp)
+        b = results['build']
+        print(f"build: {b['rows']} rows from {b['images']} images, cold {b['cold_s']:.2f} s, warm {b['warm_s']:.3f} s")
+        if not len(webapp.ENC):
+            sys.exit('no faces found in the images')
+        real = webapp.ENC.encodings.copy()
+
+        results['stages'] = bench_stages(webapp, frames, args.repeat)
+        for stage, s in results['stages'].items():
+            print(f"stage {stage:10s} p50 {s['p50_ms']:8.2f} ms  p95 {s['p95_ms']:8.2f} ms")
+
+        results['scales'] = []
+        with webapp.app.app_context():
+            for identities in [int(s) for s in args.scales.split(',') if s]:
+                row = {'identities': identities}
+                row.update(grow_gallery(webapp, identities, args.samples, rng))
+                row['match'] = bench_match(webapp, real, args.faces, 50, rng)
+                bench_recognize(webapp, payloads, 1, min(len(payloads), 2))  # warm up
+                row['recognize'] = bench_recognize(webapp, payloads, args.clients, args.requests)
+                results['scales'].append(row)
+                m, r = row['match'][f'{args.faces}_faces'], row['recognize']
+                print(f"{identities:>7d} identities ({row['rows']} rows): load {row['load_s']:.3f} s, "
+                      f"match {args.faces} faces p50 {m['p50_ms']:.2f} ms, recognize p50 {r['p50_ms']:.1f} ms "
+                      f"p99 {r['p99_ms']:.1f} ms, {r['frames_per_s']:.1f} frames/s {r['results']}"
+                      + (f" rejected {r['rejected']}" if r['rejected'] else ''))
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=2, default=str)
+            print(f'results written to {args.json}')
+    finally:
+        if 'webapp' in locals():
+            webapp.INFERENCE.shutdown()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""Gallery compaction: accuracy report, then (with --apply) compact the store.
+
+Every student's samples are reduced to ``--k`` diverse samples plus their
+centroid, outliers dropped (see compaction.py). The report holds out
+``--holdout`` of each student's samples and matches them against the full
+and the compacted gallery built from the rest, with the app's
+MATCH_THRESHOLD and MATCH_AGG, so the shrink can be weighed against the
+change in match rate before anything is written.
+
+    python compact.py --k 3 --outlier 0.5            # report only
+    python compact.py --k 3 --outlier 0.5 --apply --json compact_report.json
+
+Students compacted earlier only contribute their remaining samples to the
+report. Set GALLERY_COMPACT=1 to keep the gallery compacted as images are
+added.
+"""
+import os, sys, json, argparse
+
+os.environ.setdefault('APP_STARTUP', '0')  # no startup build or serving pool on import
+import app as webapp
+from compaction import evaluate
+from encoding_store import CENTROID
+
+
+def print_report(r):
+    print(f"{r['students']} students, {r['queries']} held-out samples, threshold {r['threshold']}")
+    for name in ('full', 'compacted'):
+        g = r[name]
+        print(f"  {name:9s} {g['rows']:8d} rows  match {100 * g['match_rate']:6.2f}%  "
+              f"wrong {100 * g['wrong_rate']:5.2f}%  rejected {100 * g['reject_rate']:6.2f}%  "
+              f"{g['ms_per_query']:.3f} ms/query")
+    delta = 100 * (r['compacted']['match_rate'] - r['full']['match_rate'])
+    print(f"  {r['shrink']:.1f}x fewer rows, match rate {delta:+.2f} points")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    ap.add_argument('--k', type=int, default=webapp.COMPACT_K, help='diverse samples kept per student')
+    ap.add_argument('--outlier', type=float, default=webapp.COMPACT_OUTLIER,
+                    help='drop samples farther than this from the student median')
+    ap.add_argument('--holdout', type=float, default=0.2, help='fraction of samples held out for the report')
+    ap.add_argument('--seed', type=int, default=0)
+    ap.add_argument('--apply', action='store_true', help='compact the store after the report')
+    ap.add_argument('--json', help='write the report to this file')
+    args = ap.parse_args()
+
+    store = webapp.ENC
+    rows = [i for i, p in enumerate(store.paths) if not (p or '').endswith('/' + CENTROID)]
+    names = [store.names[i] for i in rows]
+    report = evaluate(names, store.encodings[rows], args.k, args.outlier, args.holdout,
+                      webapp.MATCH_THRESHOLD, webapp.MATCH_AGG, args.seed)
+    if report is None:
+        sys.exit('no student has two samples to hold one out; nothing to report')
+    print_report(report)
+    if args.apply:
+        with store.transaction():
+            before = len(store)
+            removed = store.compact_all(args.k, args.outlier)
+            reasons = {}
+            for v in store.skipped.values():
+                if len(v) > 2:
+                    reasons[v[2]] = reasons.get(v[2], 0) + 1
+        print(f"✅ compacted {before} -> {len(store)} rows ({removed} removed); "
+              f"{reasons.get('pruned', 0)} images pruned, {reasons.get('outlier', 0)} outliers")
+        report['applied'] = {'rows_before': before, 'rows_after': len(store)}
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
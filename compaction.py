@@ -0,0 +1,125 @@
+"""Per-identity gallery compaction: a centroid plus a few diverse samples.
+
+Matching cost grows with rows, not students, and enrollment bursts leave
+many near-identical samples per student. :func:`prototypes` reduces one
+student's encodings to
+
+- the inliers: samples within ``outlier`` of the student's median encoding
+  (farther ones are usually a wrong face or a bad crop; when most samples
+  are that far, none is treated as an outlier),
+- ``k`` diverse inliers: the inliers are clustered with k-means and the
+  sample nearest each cluster centre is kept, the rest are redundant,
+- the inliers' centroid, as one extra row.
+
+:func:`evaluate` holds out part of every student's samples and compares the
+match rate of the full and the compacted gallery on them.
+"""
+import time
+import numpy as np
+from gallery import Gallery
+
+
+def _kmeans(x, k, iters=10):
+    """Deterministic k-means: farthest-point seeding from the sample nearest the mean."""
+    centers = [x[np.argmin(np.linalg.norm(x - x.mean(axis=0), axis=1))]]
+    d = np.linalg.norm(x - centers[0], axis=1)
+    for _ in range(1, k):
+        centers.append(x[np.argmax(d)])
+        d = np.minimum(d, np.linalg.norm(x - centers[-1], axis=1))
+    centers = np.array(centers)
+    for _ in range(iters):
+        labels = np.argmin(((x[:, None, :] - centers[None]) ** 2).sum(-1), axis=1)
+        new = np.array([x[labels == j].mean(axis=0) if (labels == j).any() else centers[j] for j in range(k)])
+        if np.allclose(new, centers):
+            break
+        centers = new
+    return labels, centers
+
+
+def prototypes(encs, k=3, outlier=0.5):
+    """Compact one student's ``(n, 128)`` encodings.
+
+    Returns ``(centroid, keep, outliers)``: the centroid row (None when the
+    student already has ``k + 1`` rows or fewer and nothing changes), and the
+    indexes of the samples to keep and of the outliers; every other index is
+    redundant.
+    """
+    encs = np.asarray(encs, dtype=np.float32)
+    n = len(encs)
+    if n <= k + 1:
+        return None, list(range(n)), []
+    dist = np.linalg.norm(encs - np.median(encs, axis=0), axis=1)
+    inliers = np.flatnonzero(dist <= outlier)
+    if len(inliers) < max(2, (n + 1) // 2):
+        inliers = np.arange(n)
+    outliers = sorted(set(range(n)) - set(inliers.tolist()))
+    x = encs[inliers]
+    if len(x) <= k:
+        keep = inliers.tolist()
+    else:
+        labels, centers = _kmeans(x, k)
+        keep = []
+        for j in range(k):
+            members = np.flatnonzero(labels == j)
+            if len(members):
+                keep.append(int(inliers[members[np.argmin(np.linalg.norm(x[members] - centers[j], axis=1))]]))
+    return x.mean(axis=0), sorted(keep), outliers
+
+
+def compact(names, encs, k=3, outlier=0.5):
+    """Compacted ``(names, encodings)`` for a whole gallery (in memory)."""
+    encs = np.asarray(encs, dtype=np.float32)
+    rows = {}
+    for i, n in enumerate(names):
+        rows.setdefault(n, []).append(i)
+    out_names, out = [], []
+    for n, idx in rows.items():
+        centroid, keep, _ = prototypes(encs[idx], k, outlier)
+        picked = [encs[idx[i]] for i in keep] + ([centroid] if centroid is not None else [])
+        out_names += [n] * len(picked); out += picked
+    return out_names, np.asarray(out, dtype=np.float32).reshape(-1, encs.shape[1])
+
+
+def _score(gallery, queries, truth, threshold, agg):
+    t0 = time.perf_counter()
+    matches = gallery.match_identities(queries, k=1, agg=agg)
+    secs = time.perf_counter() - t0
+    correct = wrong = 0
+    for top, name in zip(matches, truth):
+        if top and top[0][1] <= threshold:
+            if top[0][0] == name:
+                correct += 1
+            else:
+                wrong += 1
+    n = max(len(truth), 1)
+    return {'rows': len(gallery), 'match_rate': correct / n, 'wrong_rate': wrong / n,
+            'reject_rate': (len(truth) - correct - wrong) / n, 'ms_per_query': 1000 * secs / n}
+
+
+def evaluate(names, encs, k=3, outlier=0.5, holdout=0.2, threshold=0.52, agg='min', seed=0):
+    """Match rate of the full vs the compacted gallery on held-out samples.
+
+    From every student with at least two samples, a ``holdout`` fraction
+    (at least one) is set aside as queries; both galleries are built from the
+    rest.
+    """
+    encs = np.asarray(encs, dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    rows = {}
+    for i, n in enumerate(names):
+        rows.setdefault(n, []).append(i)
+    train, test = [], []
+    for idx in rows.values():
+        idx = rng.permutation(idx).tolist()
+        h = max(1, int(round(len(idx) * holdout))) if len(idx) >= 2 else 0
+        test += idx[:h]; train += idx[h:]
+    if not test:
+        return None
+    train_names = [names[i] for i in train]
+    queries, truth = encs[test], [names[i] for i in test]
+    small_names, small = compact(train_names, encs[train], k, outlier)
+    full = _score(Gallery(encs[train], train_names), queries, truth, threshold, agg)
+    compacted = _score(Gallery(small, small_names), queries, truth, threshold, agg)
+    return {'students': len(rows), 'queries': len(test), 'k': k, 'outlier': outlier,
+            'threshold': threshold, 'full': full, 'compacted': compacted,
+            'shrink': full['rows'] / max(compacted['rows'], 1)}
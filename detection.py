@@ -0,0 +1,146 @@
+"""Face detection backends, downscaled detection and motion ROI gating.
+
+Detection is the dominant per-frame cost, so :class:`Detector` runs it on a
+downscaled copy (``scale``) and maps the boxes back to full resolution for
+encoding. Backends:
+
+``hog``         dlib HOG (``face_recognition`` default)
+``cnn``         dlib CNN (accurate, slow without a GPU)
+``haar``        OpenCV Haar cascade bundled with ``opencv-python``
+``opencv_dnn``  OpenCV DNN SSD detector (``dnn_model``/``dnn_config`` paths
+                to e.g. res10_300x300_ssd_iter_140000.caffemodel + deploy.prototxt)
+
+With a motion state (see :meth:`Detector.detect`) only the region that
+changed since the previous frame, plus the previous faces, is searched; a
+static frame reuses the previous boxes. Every call reports per-stage timings.
+
+All boxes are ``(top, right, bottom, left)`` in full-resolution pixels.
+"""
+import os, time
+import numpy as np
+
+BACKENDS = ('hog', 'cnn', 'haar', 'opencv_dnn')
+THUMB = 8             # motion thumbnail is 1/THUMB of the frame
+MOTION_DELTA = 18     # grey-level change that counts as motion
+ROI_MARGIN = 0.25     # ROI padding, as a fraction of its size
+
+
+def _clip(box, h, w):
+    t, r, b, l = box
+    return (max(0, int(t)), min(w, int(r)), min(h, int(b)), max(0, int(l)))
+
+
+class Detector:
+
+    def __init__(self, backend='hog', scale=1.0, upsample=1, min_face=20,
+                 dnn_model=None, dnn_config=None, dnn_confidence=0.5):
+        if backend not in BACKENDS:
+            raise ValueError(f'unknown detector {backend!r}; choose from {", ".join(BACKENDS)}')
+        if backend == 'opencv_dnn' and not (dnn_model and dnn_config
+                                            and os.path.exists(dnn_model) and os.path.exists(dnn_config)):
+            raise ValueError('opencv_dnn needs DETECT_DNN_MODEL and DETECT_DNN_CONFIG files')
+        self.backend = backend
+        self.scale = scale
+        self.upsample = upsample
+        self.min_face = min_face
+        self.dnn_model = dnn_model
+        self.dnn_config = dnn_config
+        self.dnn_confidence = dnn_confidence
+        self._impl = None
+
+    # ---------- backends (on the downscaled image) ----------
+    def _load(self):
+        if self._impl is not None:
+            return self._impl
+        if self.backend in ('hog', 'cnn'):
+            import face_recognition
+            model = self.backend
+            self._impl = lambda img: face_recognition.face_locations(img, self.upsample, model)
+        elif self.backend == 'haar':
+            import cv2
+            cascade = cv2.CascadeClassifier(os.path.join(cv2.data.haarcascades,
+                                                         'haarcascade_frontalface_default.xml'))
+            def haar(img):
+                gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+                size = max(8, int(self.min_face * self.scale))
+                found = cascade.detectMultiScale(gray, 1.1, 5, minSize=(size, size))
+                return [(y, x + w, y + h, x) for (x, y, w, h) in found]
+            self._impl = haar
+        else:
+            import cv2
+            net = cv2.dnn.readNetFromCaffe(self.dnn_config, self.dnn_model)
+            def dnn(img):
+                h, w = img.shape[:2]
+                blob = cv2.dnn.blobFromImage(cv2.cvtColor(img, cv2.COLOR_RGB2BGR), 1.0, (300, 300),
+                                             (104.0, 177.0, 123.0))
+                net.setInput(blob)
+                det = net.forward()[0, 0]
+                det = det[det[:, 2] >= self.dnn_confidence]
+                return [(y1 * h, x2 * w, y2 * h, x1 * w) for x1, y1, x2, y2 in det[:, 3:7]]
+            self._impl = dnn
+        return self._impl
+
+    def _detect_scaled(self, rgb):
+        h, w = rgb.shape[:2]
+        if self.scale != 1.0:
+            import cv2
+            small = cv2.resize(rgb, (max(1, int(w * self.scale)), max(1, int(h * self.scale))),
+                               interpolation=cv2.INTER_AREA)
+        else:
+            small = rgb
+        boxes = self._load()(small)
+        return [_clip([v / self.scale for v in box], h, w) for box in boxes]
+
+    # ---------- motion ROI ----------
+    @staticmethod
+    def thumbnail(rgb):
+        import cv2
+        h, w = rgb.shape[:2]
+        gray = cv2.cvtColor(rgb, cv2.COLOR_RGB2GRAY)
+        return cv2.resize(gray, (max(1, w // THUMB), max(1, h // THUMB)), interpolation=cv2.INTER_AREA)
+
+    @staticmethod
+    def _roi(prev_thumb, thumb, prev_boxes, h, w):
+        """Bounding box of motion and previous faces, or None when static."""
+        boxes = []
+        if prev_thumb is not None and prev_thumb.shape == thumb.shape:
+            moved = np.abs(thumb.astype(np.int16) - prev_thumb.astype(np.int16)) > MOTION_DELTA
+            if moved.any():
+                ys, xs = np.nonzero(moved)
+                boxes.append((ys.min() * THUMB, (xs.max() + 1) * THUMB, (ys.max() + 1) * THUMB, xs.min() * THUMB))
+        else:
+            return (0, w, h, 0)
+        if not boxes:
+            return None
+        boxes += [tuple(b) for b in prev_boxes]
+        t = min(b[0] for b in boxes); r = max(b[1] for b in boxes)
+        b_ = max(b[2] for b in boxes); l = min(b[3] for b in boxes)
+        pad_y, pad_x = int((b_ - t) * ROI_MARGIN), int((r - l) * ROI_MARGIN)
+        return _clip((t - pad_y, r + pad_x, b_ + pad_y, l - pad_x), h, w)
+
+    def detect(self, rgb, motion=None):
+        """Face boxes in ``rgb``, ``{stage: seconds}`` timings and motion state.
+
+        ``motion`` enables ROI gating: pass ``{}`` for a new stream and the
+        returned state on every later frame. Returns
+        ``(boxes, timings, motion)``.
+        """
+        timings = {}
+        h, w = rgb.shape[:2]
+        if motion is None:
+            t0 = time.perf_counter()
+            boxes = self._detect_scaled(rgb)
+            timings[self.backend] = time.perf_counter() - t0
+            return boxes, timings, None
+        t0 = time.perf_counter()
+        thumb = self.thumbnail(rgb)
+        prev_boxes = motion.get('boxes', [])
+        roi = self._roi(motion.get('thumb'), thumb, prev_boxes, h, w)
+        timings['motion'] = time.perf_counter() - t0
+        if roi is None:  # static scene: nothing new to find; keep the reference
+            return list(prev_boxes), timings, dict(motion)  # thumb so slow drift adds up
+        t, r, b, l = roi
+        t0 = time.perf_counter()
+        boxes = [(bt + t, br + l, bb + t, bl + l) for bt, br, bb, bl in self._detect_scaled(rgb[t:b, l:r])]
+        timings[self.backend] = time.perf_counter() - t0
+        return boxes, timings, {'thumb': thumb, 'boxes': boxes}
@@ -0,0 +1,632 @@
+"""Incremental store of face encodings, one row per enrolled image.
+
+Every row remembers the image it came from (path relative to ``face_data/``)
+together with the file's mtime/size stamp and a content hash, so a sync only
+encodes images that are new or have actually changed on disk.
+
+On disk the gallery is a contiguous float32 ``.npy`` matrix that is
+memory-mapped on load, a ``.rows.npz`` with every row's identity as an
+int32 index into a table of names, and a ``.books.json`` with the per-row
+paths, stamps and hashes plus the skip records. Loading reads only the
+matrix and the row table; the bookkeeping file is opened then but only
+parsed when a sync or edit first needs it. The small meta file
+(``encodings_meta.json``) names the files of the current generation and is
+replaced last, so readers never pair a new matrix with old names. Old
+files are unlinked, which is safe for other processes that still have
+them mapped or open.
+
+An optional ANN index (see :mod:`ann_index`) is persisted next to the matrix
+as ``ann_index.npz`` and tagged with the matrix file it was built for.
+
+With compaction (:meth:`EncodingStore.compact_user`) a student keeps a few
+diverse samples plus a centroid row (path ``<user>/*centroid``); the other
+images get ``pruned``/``outlier`` skip records. Any later change to that
+student's images drops the centroid and re-encodes the pruned images, so
+the next compaction starts again from every sample.
+
+Several processes can share one store. Every save bumps the ``generation``
+in the meta file; :meth:`EncodingStore.refresh` reloads when the meta file's
+stat stamp changes, and :meth:`EncodingStore.transaction` serializes writers
+across threads and processes with a lock file. Readers match against
+``snapshot``, which only ever changes by being replaced with a complete,
+saved gallery.
+
+Neither lock ever blocks the OS thread: waiters poll with the store's
+``sleep`` (``eventlet.sleep`` in the web app, whose green threads all share
+one thread), so other requests keep being served meanwhile. Syncs encode
+before taking the locks and only hold them to merge the results.
+"""
+import os, sys, copy, json, time, hashlib, threading
+from contextlib import contextmanager
+import numpy as np
+from gallery import Gallery, DIM
+from ann_index import INDEX_NAME
+from compaction import prototypes
+
+try:
+    import fcntl
+except ImportError:  # Windows: writers are only serialized within one process
+    fcntl = None
+
+try:
+    from greenlet import getcurrent as _owner  # a green thread, or a thread's main greenlet
+except ImportError:
+    _owner = threading.get_ident
+
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png')
+META_NAME = 'encodings_meta.json'
+LEGACY_JSON = 'encodings.json'
+LOCK_NAME = '.store.lock'
+CENTROID = '*centroid'  # relpath suffix of a compacted student's centroid row
+COMPACTED = ('pruned', 'outlier')  # skip reasons set by compaction
+
+
+def _book_field(key):
+    """Property for one bookkeeping list/dict, read from disk on first use."""
+    def get(self):
+        return self._bookkeeping()[key]
+    def set(self, value):
+        self._bookkeeping()[key] = value
+    return property(get, set)
+
+
+def file_stamp(path):
+    st = os.stat(path)
+    return [int(st.st_mtime_ns), int(st.st_size)]
+
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+@contextmanager
+def _file_lock(path, sleep=time.sleep, poll=0.05):
+    if fcntl is None:
+        yield
+        return
+    with open(path, 'a') as f:
+        while True:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:  # another process is saving
+                sleep(poll)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class StoreLock:
+    """Reentrant lock for green and OS threads alike.
+
+    A ``threading.RLock`` is shared by every green thread of an unpatched
+    eventlet server (they run on one OS thread), and blocking on it would
+    stall the hub. This one is owned per green thread and waits by polling
+    with ``sleep``.
+    """
+
+    def __init__(self, sleep=time.sleep, poll=0.01):
+        self.sleep = sleep
+        self.poll = poll
+        self._lock = threading.Lock()
+        self._owner = None
+        self._count = 0
+
+    def acquire(self, blocking=True):
+        me = _owner()
+        if self._owner is me:
+            self._count += 1
+            return True
+        while not self._lock.acquire(False):
+            if not blocking:
+                return False
+            self.sleep(self.poll)
+        self._owner, self._count = me, 1
+        return True
+
+    def release(self):
+        self._count -= 1
+        if not self._count:
+            self._owner = None
+            self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class EncodingStore:
+    """In-memory gallery rows plus their on-disk persistence.
+
+    Names and encodings live in ``gallery`` (see :class:`gallery.Gallery`);
+    the store keeps the per-row paths, stamps and hashes alongside, loading
+    them lazily. A freshly loaded gallery matches straight off the read-only
+    memory map and only copies it on the first edit.
+
+    ``encode`` callables passed to the sync methods take an absolute image
+    path and return a 128-d encoding, or ``None`` when no face was found.
+    Images without a face are remembered in ``skipped`` so they are not
+    re-encoded on every sync.
+
+    Edits go to ``gallery``, a private copy of ``snapshot`` made on the first
+    edit; :meth:`save` publishes it as the new ``snapshot``. ``sleep`` is
+    how lock waiters wait (see :class:`StoreLock`).
+    """
+
+    def __init__(self, model_dir, face_dir, index=None, sleep=time.sleep):
+        self.model_dir = model_dir
+        self.face_dir = face_dir
+        self.meta_path = os.path.join(model_dir, META_NAME)
+        self.index_path = os.path.join(model_dir, INDEX_NAME)
+        self.lock_path = os.path.join(model_dir, LOCK_NAME)
+        self.index = index  # untrained template; every gallery gets its own copy
+        self.matrix_name = None
+        self.generation = 0
+        self.sleep = sleep
+        self.lock = StoreLock(sleep)
+        self._in_transaction = False
+        self._stamp = None
+        self._book_file = None
+        self._book_lock = threading.Lock()
+        self._clear()
+
+    def _new_index(self):
+        return copy.copy(self.index) if self.index is not None else None
+
+    def _clear(self):
+        self.gallery = self.snapshot = Gallery(index=self._new_index())
+        # skipped: relpath -> [stamp, hash, reason]
+        self._set_books({'paths': [], 'stamps': [], 'hashes': [], 'skipped': {}})
+        self.dirty = False
+
+    def _set_books(self, book, f=None):
+        with self._book_lock:
+            if self._book_file is not None:
+                self._book_file.close()
+            self._book, self._book_file = book, f
+
+    def _bookkeeping(self):
+        with self._book_lock:
+            if self._book_file is not None:
+                with self._book_file as f:
+                    self._book = json.load(f)
+                self._book_file = None
+            return self._book
+
+    paths = _book_field('paths')
+    stamps = _book_field('stamps')
+    hashes = _book_field('hashes')
+    skipped = _book_field('skipped')
+
+    def __len__(self):
+        return len(self.gallery)
+
+    @property
+    def names(self):
+        return self.gallery.names
+
+    @property
+    def encodings(self):
+        return self.gallery.matrix
+
+    # ---------- persistence ----------
+    def _meta_stamp(self):
+        try:
+            st = os.stat(self.meta_path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def load(self):
+        """(Re)load from disk; the current state is kept if reading fails."""
+        stamp = self._meta_stamp()
+        if stamp is None:
+            self._clear()
+            legacy = os.path.join(self.model_dir, LEGACY_JSON)
+            if os.path.exists(legacy):
+                self.migrate_json(legacy)
+            return self
+        with open(self.meta_path, 'r') as f:
+            meta = json.load(f)
+        matrix_name = meta.get('matrix')
+        book, book_file = None, None
+        if 'rows' in meta:
+            with np.load(os.path.join(self.model_dir, meta['rows'])) as rows:
+                labels, ids = rows['names'].tolist(), rows['ids']
+            book_file = open(os.path.join(self.model_dir, meta['books']), 'rb')
+        else:  # written before the row table: names and bookkeeping inline
+            labels, ids = np.unique(np.asarray(meta.get('names', []), dtype=object), return_inverse=True)
+            book = {k: meta.get(k, []) for k in ('paths', 'stamps', 'hashes')}
+            book['skipped'] = meta.get('skipped', {})
+        try:
+            encodings = None
+            if matrix_name and len(ids):
+                encodings = np.load(os.path.join(self.model_dir, matrix_name), mmap_mode='r')
+            index = self._new_index()
+            try:
+                gallery = Gallery.from_ids(encodings, labels, ids, index=index)
+            except (ValueError, IndexError) as e:
+                raise ValueError(f'{self.meta_path}: {e}')
+            if index is not None:
+                if not index.load(self.index_path, matrix_name, len(ids)) and index.needs_fit(len(ids)):
+                    gallery.fit_index()
+        except BaseException:
+            if book_file is not None:
+                book_file.close()
+            raise
+        self._set_books(book, book_file)
+        self.matrix_name = matrix_name
+        self.generation = meta.get('generation', 0)
+        self.gallery = self.snapshot = gallery
+        self.dirty = False
+        self._stamp = stamp
+        return self
+
+    def refresh(self):
+        """Reload if another process saved since; True when reloaded.
+
+        Costs one ``stat`` when nothing changed.
+        """
+        stamp = self._meta_stamp()
+        if stamp is None or stamp == self._stamp:
+            return False
+        try:
+            self.load()
+        except FileNotFoundError:  # superseded while reading; the next call catches up
+            return False
+        return True
+
+    @contextmanager
+    def transaction(self):
+        """Exclusive edit across threads and processes.
+
+        Catches up with other processes' saves first and saves (a new
+        generation) on exit if anything changed; on error the unsaved edits
+        are dropped by reloading from disk. A nested transaction joins the
+        outer one.
+        """
+        with self.lock:
+            if self._in_transaction:
+                yield self
+                return
+            with _file_lock(self.lock_path, self.sleep):
+                self._in_transaction = True
+                try:
+                    self.refresh()
+                    try:
+                        yield self
+                    except BaseException:
+                        self.load()
+                        raise
+                    if self.dirty:
+                        self.save()
+                finally:
+                    self._in_transaction = False
+
+    @staticmethod
+    def _files(matrix_name):
+        """Row table and bookkeeping file names that go with a matrix file."""
+        stem = matrix_name[:-len('.npy')]
+        return stem + '.rows.npz', stem + '.books.json'
+
+    def _write(self, name, write, mode='wb'):
+        tmp = os.path.join(self.model_dir, name + '.tmp')
+        with open(tmp, mode) as f:
+            write(f)
+        os.replace(tmp, os.path.join(self.model_dir, name))
+
+    def save(self):
+        old = self.matrix_name
+        if self.index is not None and self.gallery.index.needs_fit(len(self)):
+            self._edit().fit_index()
+        self.generation += 1
+        self.matrix_name = f'encodings-{time.time_ns():x}.npy'
+        rows_name, books_name = self._files(self.matrix_name)
+        labels, ids = self.gallery.identities()
+        self._write(self.matrix_name, lambda f: np.save(f, np.ascontiguousarray(self.encodings, dtype=np.float32)))
+        self._write(rows_name, lambda f: np.savez(f, ids=ids.astype(np.int32), names=np.array(labels, dtype=str)))
+        self._write(books_name, lambda f: json.dump(self._bookkeeping(), f), 'w')
+        meta = {"matrix": self.matrix_name, "rows": rows_name, "books": books_name,
+                "generation": self.generation, "dim": DIM, "count": len(self)}
+        if self.index is not None:  # before the meta file: readers go by the meta
+            self.gallery.index.save(self.index_path, self.matrix_name)
+        self._write(META_NAME, lambda f: json.dump(meta, f), 'w')
+        self._stamp = self._meta_stamp()
+        self.snapshot = self.gallery
+        self.dirty = False
+        if old and old != self.matrix_name:
+            for name in (old,) + self._files(old):
+                try:
+                    os.remove(os.path.join(self.model_dir, name))
+                except OSError:
+                    pass
+
+    def migrate_json(self, json_path):
+        """One-time import of the old ``encodings.json`` gallery.
+
+        Files written before per-image rows existed carry no paths; their rows
+        are kept (so recognition keeps working) and are replaced the next time
+        that user's folder is synced.
+        """
+        with open(json_path, 'r') as f:
+            data = json.load(f)
+        names = data.get('names', [])
+        encs = data.get('encodings', [])
+        self._clear()
+        encs = np.asarray(encs, dtype=np.float32).reshape(-1, DIM)
+        self.gallery = Gallery(encs, names, index=self._new_index())
+        self.paths = data.get('paths', [None] * len(names))
+        self.stamps = data.get('stamps', [None] * len(names))
+        self.hashes = data.get('hashes', [None] * len(names))
+        self.skipped = data.get('skipped', {})
+        self.save()
+        return len(self.names)
+
+    # ---------- row edits ----------
+    def _edit(self):
+        """The working gallery, copied off the published snapshot on first use."""
+        if self.gallery is self.snapshot:
+            self.gallery = self.snapshot.copy()
+        self.dirty = True
+        return self.gallery
+
+    def _keep(self, keep):
+        self._edit().keep(keep)
+        self.paths = [v for v, k in zip(self.paths, keep) if k]
+        self.stamps = [v for v, k in zip(self.stamps, keep) if k]
+        self.hashes = [v for v, k in zip(self.hashes, keep) if k]
+
+    def _extend(self, rows):
+        if not rows:
+            return
+        gallery = self._edit()
+        for _, relpath, stamp, digest, _ in rows:
+            self.paths.append(relpath); self.stamps.append(stamp); self.hashes.append(digest)
+        gallery.add([r[0] for r in rows], [r[4] for r in rows])
+
+    def remove_user(self, username):
+        """Drop every row (and skip record) belonging to ``username``."""
+        prefix = username + '/'
+        keep = [n != username for n in self.names]
+        removed = keep.count(False)
+        if removed:
+            self._keep(keep)
+        self._drop_skipped(lambda p: p.startswith(prefix))
+        return removed
+
+    def _drop_skipped(self, drop):
+        skipped = {p: v for p, v in self.skipped.items() if not drop(p)}
+        if len(skipped) != len(self.skipped):
+            self.skipped = skipped
+            self.dirty = True
+
+    # ---------- sync with face_data/ ----------
+    def _scan(self, username):
+        folder = os.path.join(self.face_dir, username)
+        if not os.path.isdir(folder):
+            return {}
+        found = {}
+        for fname in os.listdir(folder):
+            if fname.lower().endswith(IMAGE_EXTS):
+                rel = username + '/' + fname
+                found[rel] = file_stamp(os.path.join(folder, fname))
+        return found
+
+    def todo_user(self, username):
+        """Images of ``username`` a sync would encode, as ``(relpath, stamp, digest)``.
+
+        Read-only, so it runs without the lock; :meth:`merge_results` replans
+        under the lock and ignores results that no longer apply.
+        """
+        names, paths, stamps, hashes, skipped = self.names, self.paths, self.stamps, self.hashes, self.skipped
+        known = {p: i for i, (n, p) in enumerate(zip(names, paths)) if n == username and p}
+        todo = []
+        for rel, stamp in self._scan(username).items():
+            i, skip = known.get(rel), skipped.get(rel)
+            if (i is not None and stamps[i] == stamp) or (skip is not None and skip[0] == stamp):
+                continue
+            digest = file_hash(os.path.join(self.face_dir, rel))
+            if (i is not None and hashes[i] == digest) or (skip is not None and skip[1] == digest):
+                continue
+            todo.append((rel, stamp, digest))
+        return todo
+
+    def plan_user(self, username):
+        """Drop ``username``'s rows for deleted or changed images.
+
+        Returns ``(todo, removed)``: the images still to encode, as
+        ``(relpath, stamp, digest)``, and the number of rows dropped.
+        """
+        on_disk = self._scan(username)
+        keep = [True] * len(self.names)
+        known = {}
+        removed = 0
+        centroid = None
+        for i, (n, p) in enumerate(zip(self.names, self.paths)):
+            if n != username:
+                continue
+            if p == username + '/' + CENTROID:
+                centroid = i
+            elif p is None or p not in on_disk:  # migrated row or deleted file
+                keep[i] = False; removed += 1
+            else:
+                known[p] = i
+        todo = []
+        for rel, stamp in on_disk.items():
+            i = known.get(rel)
+            if i is not None and self.stamps[i] == stamp:
+                continue
+            skip = self.skipped.get(rel)
+            if skip is not None and skip[0] == stamp:
+                continue
+            digest = file_hash(os.path.join(self.face_dir, rel))
+            if i is not None and self.hashes[i] == digest:
+                self.stamps[i] = stamp  # touched, not changed
+                self.dirty = True
+                continue
+            if skip is not None and skip[1] == digest:
+                skip[0] = stamp
+                self.dirty = True
+                continue
+            if i is not None:
+                keep[i] = False; removed += 1
+            todo.append((rel, stamp, digest))
+        prefix = username + '/'
+        gone = any(rel.startswith(prefix) and rel not in on_disk and len(skip) > 2 and skip[2] in COMPACTED
+                   for rel, skip in self.skipped.items())
+        if centroid is not None and (removed or todo or gone):
+            # compacted student changed: start again from every sample
+            keep[centroid] = False; removed += 1
+            planned = {t[0] for t in todo}
+            for rel, skip in list(self.skipped.items()):
+                if rel in on_disk and rel not in planned and len(skip) > 2 and skip[2] in COMPACTED:
+                    del self.skipped[rel]
+                    todo.append((rel, on_disk[rel], skip[1]))
+            self.dirty = True
+        if removed:
+            self._keep(keep)
+        self._drop_skipped(lambda p: p.startswith(prefix) and p not in on_disk)
+        return todo, removed
+
+    def add_results(self, username, results):
+        """Store encoded images: ``(relpath, stamp, digest, enc, reason)``.
+
+        ``enc`` None marks the image skipped (``reason`` says why) so it is not
+        retried until the file changes. Returns the number of rows added.
+        """
+        rows = []
+        for rel, stamp, digest, enc, reason in results:
+            if enc is None:
+                self.skipped[rel] = [stamp, digest, reason or 'no_face']
+                self.dirty = True
+                continue
+            self.skipped.pop(rel, None)
+            rows.append((username, rel, stamp, digest, enc))
+        self._extend(rows)
+        return len(rows)
+
+    def merge_results(self, username, done):
+        """Replan ``username`` and store the encodings in ``done`` that still apply.
+
+        ``done`` maps ``(relpath, digest)`` to ``(enc, reason)`` as encoded
+        from :meth:`todo_user`; call inside a transaction. Returns ``(added,
+        removed, left)``, ``left`` being the images still to encode (changed
+        since, or revived by an invalidated compaction).
+        """
+        todo, removed = self.plan_user(username)
+        rows, left = [], []
+        for rel, stamp, digest in todo:
+            r = done.get((rel, digest))
+            if r is None:
+                left.append((rel, stamp, digest))
+            else:
+                rows.append((rel, stamp, digest) + tuple(r))
+        return self.add_results(username, rows), removed, left
+
+    def _encode(self, todo, encode, log=None):
+        """Encode ``todo``; unreadable images are left out (and retried next sync).
+
+        Any other error (a busy or failed encoder) propagates.
+        """
+        done = {}
+        for rel, stamp, digest in todo:
+            path = os.path.join(self.face_dir, rel)
+            try:
+                done[(rel, digest)] = (encode(path), None)
+            except (OSError, ValueError) as e:  # PIL's UnidentifiedImageError is an OSError
+                if log: log.warning('skip %s: %s', path, e)
+        return done
+
+    def _merge(self, username, done, encode, log):
+        added, removed, left = self.merge_results(username, done)
+        if left:  # few; encoded under the lock
+            more, _, _ = self.merge_results(username, self._encode(left, encode, log))
+            added += more
+        return added, removed
+
+    def sync_user(self, username, encode, log=None):
+        """Bring ``username``'s rows in line with their folder.
+
+        Images are encoded first; the store is only locked to merge them.
+        Returns ``(added, removed)`` row counts. If ``encode`` fails for a
+        reason other than an unreadable image, nothing is merged and the
+        error propagates; the images are still on disk for the next sync.
+        """
+        with self.lock:
+            self.refresh()
+        done = self._encode(self.todo_user(username), encode, log)
+        with self.transaction():
+            return self._merge(username, done, encode, log)
+
+    def compact_user(self, username, k=3, outlier=0.5):
+        """Keep ``k`` diverse samples of ``username`` plus their centroid.
+
+        Redundant and outlier images get ``pruned``/``outlier`` skip records
+        (see :func:`compaction.prototypes`). Returns the rows removed.
+        """
+        centroid_path = username + '/' + CENTROID
+        rows = [i for i, (n, p) in enumerate(zip(self.names, self.paths))
+                if n == username and p != centroid_path]
+        old = [i for i, (n, p) in enumerate(zip(self.names, self.paths)) if n == username and p == centroid_path]
+        centroid, keep, outliers = prototypes(self.encodings[rows], k, outlier)
+        if centroid is None:
+            return 0
+        mask = [True] * len(self.names)
+        for i in old:
+            mask[i] = False
+        kept, odd = set(keep), set(outliers)
+        for j, i in enumerate(rows):
+            if j not in kept:
+                mask[i] = False
+                self.skipped[self.paths[i]] = [self.stamps[i], self.hashes[i],
+                                               'outlier' if j in odd else 'pruned']
+        self._keep(mask)
+        self._extend([(username, centroid_path, None, None, centroid)])
+        return mask.count(False) - 1
+
+    def compact_all(self, k=3, outlier=0.5):
+        """:meth:`compact_user` for every student; returns the rows removed."""
+        return sum(self.compact_user(u, k, outlier) for u in sorted(set(self.names)))
+
+    def users_on_disk(self):
+        if not os.path.isdir(self.face_dir):
+            return []
+        return sorted(u for u in os.listdir(self.face_dir) if os.path.isdir(os.path.join(self.face_dir, u)))
+
+    def sync_all(self, encode, log=None):
+        """Sync every user folder and drop rows for folders that are gone.
+
+        Everything is encoded first, then merged in one transaction.
+        """
+        with self.lock:
+            self.refresh()
+        users = self.users_on_disk()
+        done = {u: self._encode(self.todo_user(u), encode, log) for u in users}
+        added = removed = 0
+        with self.transaction():
+            for gone in set(self.names) - set(users):
+                removed += self.remove_user(gone)
+            for username in users:
+                a, r = self._merge(username, done[username], encode, log)
+                added += a; removed += r
+        return added, removed
+
+
+if __name__ == '__main__':
+    # python encoding_store.py migrate [models_dir] [face_data_dir]
+    if len(sys.argv) < 2 or sys.argv[1] != 'migrate':
+        sys.exit('usage: python encoding_store.py migrate [models_dir] [face_data_dir]')
+    base = os.path.dirname(os.path.abspath(__file__))
+    model_dir = sys.argv[2] if len(sys.argv) > 2 else os.path.join(base, 'models')
+    face_dir = sys.argv[3] if len(sys.argv) > 3 else os.path.join(base, 'face_data')
+    store = EncodingStore(model_dir, face_dir)
+    n = store.migrate_json(os.path.join(model_dir, LEGACY_JSON))
+    print(f'✅ Migrated {n} encodings to {store.matrix_name}')
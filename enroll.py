@@ -0,0 +1,164 @@
+"""Bulk enrollment: encode every image under face_data/ across a process pool.
+
+Images are planned per student folder (only new or changed files, exactly as
+the app's incremental sync), encoded in parallel, and written to the
+encoding store every ``--chunk`` images, so an interrupted run resumes from
+its last checkpoint. Images with no face, several faces, a face below
+QUALITY_MIN_FACE or that fail to decode are recorded in the store's
+``skipped`` table (not retried until the file changes) and listed in a CSV
+report. Images lost to a worker or pool failure are only logged and counted
+as ``failed``; they are encoded on the next run. Missing ``User`` rows are created
+as students with a random password.
+
+The store is only locked while a checkpoint is merged and saved, so a
+running web app keeps serving and accepting uploads meanwhile, and picks up
+every checkpoint as it is saved.
+
+    python enroll.py --workers 8 --chunk 500 --report enroll_report.csv
+"""
+import os, csv, sys, time, secrets, argparse
+from concurrent.futures import wait, FIRST_COMPLETED
+
+os.environ.setdefault('APP_STARTUP', '0')  # no startup build or serving pool on import
+import app as webapp
+from inference import InferenceService, enroll_file
+
+
+def drop_gone(store, users, log):
+    with store.transaction():
+        for gone in set(store.names) - set(users):
+            log(f'- {gone}: folder gone, {store.remove_user(gone)} rows dropped')
+
+
+def plan(store, users):
+    """``[(username, relpath, stamp, digest)]`` still to encode (read-only, unlocked)."""
+    with store.lock:
+        store.refresh()
+    return [(username,) + r for username in users for r in store.todo_user(username)]
+
+
+def checkpoint(store, done, log):
+    """Merge ``[(username, (relpath, stamp, digest, enc, status))]`` in one transaction."""
+    by_user = {}
+    for username, (rel, stamp, digest, enc, status) in done:
+        by_user.setdefault(username, {})[(rel, digest)] = (enc, status)
+    added = 0
+    with store.transaction():
+        for username, results in by_user.items():
+            a, removed, _ = store.merge_results(username, results)
+            added += a
+            if removed:
+                log(f'- {username}: {removed} stale rows dropped')
+    return added
+
+
+def encode_all(store, todo, service, chunk, allow_multi, log):
+    """Encode ``todo`` on ``service``, saving the store every ``chunk`` images."""
+    counts = {'ok': 0, 'no_face': 0, 'multi_face': 0, 'face_too_small': 0, 'decode_error': 0, 'failed': 0}
+    window = 4 * service.workers  # jobs in flight; below max_pending
+    running, done = {}, []
+    items = iter(todo)
+    added = finished = 0
+    t0 = time.perf_counter()
+    try:
+        while True:
+            for item in items:
+                fut = service.submit(enroll_file, os.path.join(store.face_dir, item[1]), allow_multi)
+                running[fut] = item
+                if len(running) >= window:
+                    break
+            if not running:
+                break
+            ready, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in ready:
+                username, rel, stamp, digest = running.pop(fut)
+                try:
+                    status, faces, enc = fut.result()
+                except Exception as e:  # the worker or the pool, not the image: retry next run
+                    counts['failed'] += 1
+                    log(f'! {rel}: {type(e).__name__}: {e}')
+                    continue
+                counts[status] += 1
+                done.append((username, (rel, stamp, digest, enc, status)))
+            finished += len(ready)
+            if len(done) >= chunk:
+                added += checkpoint(store, done, log); done = []
+                rate = finished / (time.perf_counter() - t0)
+                log(f'  {finished}/{len(todo)} images, {rate:.1f}/s (checkpoint saved)')
+    finally:  # also on Ctrl-C: keep what is already encoded
+        if done:
+            added += checkpoint(store, done, log)
+    return added, counts
+
+
+def create_users(users):
+    """Student rows for folders with no matching user; returns the names created."""
+    with webapp.app.app_context():
+        webapp.db.create_all()
+        existing = {u for (u,) in webapp.db.session.query(webapp.User.username)}
+        created = [u for u in users if u not in existing]
+        for username in created:
+            webapp.db.session.add(webapp.User(username=username, password=secrets.token_urlsafe(12),
+                                              role='student'))
+        webapp.db.session.commit()
+    return created
+
+
+def write_report(path, store):
+    """One row per image the store holds no encoding for, with the reason."""
+    rows = sorted((rel, v[2] if len(v) > 2 else 'no_face') for rel, v in store.skipped.items())
+    with open(path, 'w', newline='') as f:
+        w = csv.writer(f)
+        w.writerow(['image', 'reason'])
+        w.writerows(rows)
+    return len(rows)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    ap.add_argument('--face-dir', default=webapp.FACE_DIR)
+    ap.add_argument('--workers', type=int, default=0, help='0 = cpu count - 1')
+    ap.add_argument('--chunk', type=int, default=500, help='images per checkpoint')
+    ap.add_argument('--report', default='enroll_report.csv')
+    ap.add_argument('--allow-multi', action='store_true',
+                    help='enroll multi-face images from their largest face')
+    ap.add_argument('--no-users', action='store_true', help='do not create User rows')
+    args = ap.parse_args()
+
+    store = webapp.ENC
+    store.face_dir = args.face_dir
+    service = InferenceService(workers=args.workers or None,
+                               min_face=webapp.QUALITY_MIN_FACE if webapp.QUALITY_GATE else 0)
+    service.max_pending = 8 * service.workers
+    try:
+        users = store.users_on_disk()
+        drop_gone(store, users, print)
+        todo = plan(store, users)
+        print(f'{len(users)} folders, {len(todo)} images to encode, {len(store)} rows in the store')
+        added, counts = encode_all(store, todo, service, args.chunk, args.allow_multi, print)
+        # images changed during the run, or revived by an invalidated compaction
+        tried = {(u, rel, digest) for u, rel, _, digest in todo}
+        todo = [t for t in plan(store, users) if (t[0], t[1], t[3]) not in tried]
+        if todo:
+            print(f'{len(todo)} more images to encode')
+            more, again = encode_all(store, todo, service, args.chunk, args.allow_multi, print)
+            added += more
+            counts = {k: v + again[k] for k, v in counts.items()}
+        if webapp.GALLERY_COMPACT:
+            with store.transaction():
+                print(f'{store.compact_all(webapp.COMPACT_K, webapp.COMPACT_OUTLIER)} rows compacted away')
+    except KeyboardInterrupt:
+        sys.exit('interrupted; progress is checkpointed, run again to resume')
+    finally:
+        service.shutdown()
+    print(f'✅ {added} encodings added ({len(store)} rows), ' +
+          ', '.join(f'{k}: {v}' for k, v in counts.items()))
+    if not args.no_users:
+        enrolled = set(store.names)
+        created = create_users([u for u in users if u in enrolled])
+        print(f'✅ {len(created)} student accounts created')
+    print(f'{write_report(args.report, store)} images without an encoding listed in {args.report}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+"""Vectorized matcher over the enrolled face encodings.
+
+The gallery is one ``(N, 128)`` float32 matrix with the squared norm of every
+row cached, so all faces of a frame are matched with a single matrix
+product::
+
+    ||q - g||^2 = ||q||^2 + ||g||^2 - 2 q.g
+
+Rows are grouped by identity (username) for per-student aggregation.
+
+An optional approximate index (see :mod:`ann_index`) can be attached as
+``gallery.index``; large galleries then score only each query's candidate
+rows, still with exact distances.
+
+Edits are copy-on-write when needed: :meth:`Gallery.copy` gives a gallery
+that can be edited while readers keep matching against the original.
+"""
+import copy
+import numpy as np
+
+DIM = 128
+MIN_CAPACITY = 256
+AGGREGATES = ('min', 'mean')
+
+
+class Gallery:
+    """Preallocated encoding matrix plus the name of every row.
+
+    A gallery built over an existing array (for example the memory-mapped
+    store file) uses it as-is and only copies into its own growable buffer on
+    the first ``add``.
+    """
+
+    def __init__(self, encodings=None, names=None, dim=DIM, index=None):
+        self.dim = dim
+        self.index = index
+        if encodings is None:
+            encodings = np.zeros((0, dim), dtype=np.float32)
+        encodings = np.asarray(encodings, dtype=np.float32).reshape(-1, dim)
+        self._mat = encodings
+        self._sq = np.einsum('ij,ij->i', encodings, encodings)
+        self.n = len(encodings)
+        self.names = list(names or [])
+        if len(self.names) != self.n:
+            raise ValueError(f'{len(self.names)} names for {self.n} encodings')
+        self._groups = None
+        self._spare = True  # may append into the buffer's unused rows
+
+    @classmethod
+    def from_ids(cls, encodings, labels, ids, dim=DIM, index=None):
+        """Gallery from a name table and every row's index into it (as saved by
+        :meth:`identities`); the identity grouping is taken as given."""
+        labels = list(labels)
+        ids = np.asarray(ids, dtype=np.int64)
+        g = cls(encodings, np.asarray(labels, dtype=object)[ids].tolist(), dim, index)
+        if g.n:
+            g._groups = (labels, ids, g._grouping(ids))
+        return g
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def matrix(self):
+        return self._mat[:self.n]
+
+    @property
+    def capacity(self):
+        return len(self._mat)
+
+    # ---------- edits ----------
+    def copy(self):
+        """Editable copy; this gallery stays unchanged for its readers.
+
+        The copy shares the matrix buffer and takes over its spare rows, so
+        its appends never touch rows visible here; ``keep`` always compacts
+        into new arrays, and the index is copied (it replaces, never
+        mutates, its arrays).
+        """
+        g = object.__new__(Gallery)
+        g.__dict__.update(self.__dict__)
+        g.names = list(self.names)
+        g.index = copy.copy(self.index)
+        self._spare = False
+        return g
+
+    def _reserve(self, extra):
+        need = self.n + extra
+        if need <= len(self._mat) and self._mat.flags.writeable and self._spare:
+            return
+        cap = max(MIN_CAPACITY, need, 2 * len(self._mat))
+        mat = np.empty((cap, self.dim), dtype=np.float32)
+        sq = np.empty(cap, dtype=np.float32)
+        mat[:self.n] = self._mat[:self.n]
+        sq[:self.n] = self._sq[:self.n]
+        self._mat, self._sq = mat, sq
+        self._spare = True
+
+    def add(self, names, encodings):
+        encodings = np.asarray(encodings, dtype=np.float32).reshape(-1, self.dim)
+        if len(names) != len(encodings):
+            raise ValueError(f'{len(names)} names for {len(encodings)} encodings')
+        if not len(encodings):
+            return
+        self._reserve(len(encodings))
+        lo, hi = self.n, self.n + len(encodings)
+        self._mat[lo:hi] = encodings
+        self._sq[lo:hi] = np.einsum('ij,ij->i', encodings, encodings)
+        self.names.extend(names)
+        self.n = hi
+        self._groups = None
+        if self.index is not None:
+            self.index.add(encodings)
+
+    def keep(self, mask):
+        """Keep only the rows where ``mask`` is true (compacts the matrix)."""
+        mask = np.asarray(mask, dtype=bool)
+        self._mat = self._mat[:self.n][mask]
+        self._sq = self._sq[:self.n][mask]
+        self.names = [v for v, k in zip(self.names, mask) if k]
+        self.n = len(self._mat)
+        self._groups = None
+        self._spare = True
+        if self.index is not None:
+            self.index.keep(mask)
+
+    def fit_index(self):
+        if self.index is not None and self.n:
+            self.index.fit(self.matrix)
+
+    def _indexed(self):
+        return self.index is not None and self.index.active(self.n)
+
+    # ---------- matching ----------
+    def distances(self, queries, rows=None):
+        """Euclidean distance from every query to every row (or to ``rows``),
+        shape ``(F, N)``."""
+        q = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        if rows is None:
+            mat, sq = self.matrix, self._sq[:self.n]
+        else:
+            mat, sq = self._mat[rows], self._sq[rows]
+        d2 = mat @ q.T                     # (N, F)
+        d2 *= -2
+        d2 += sq[:, None]
+        d2 += np.einsum('ij,ij->i', q, q)[None, :]
+        np.maximum(d2, 0, out=d2)
+        return np.sqrt(d2, out=d2).T
+
+    def match(self, queries, k=1):
+        """Top-``k`` rows per query: ``(dists, rows)``, both shape ``(F, k)``.
+
+        With an active index, queries with fewer than ``k`` candidates are
+        padded with ``inf`` distances and row ``-1``.
+        """
+        q = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        if not self._indexed():
+            return self._topk(self.distances(q), k)
+        k = min(k, self.n)
+        dists = np.full((len(q), k), np.inf, dtype=np.float32)
+        rows = np.full((len(q), k), -1, dtype=np.int64)
+        for i, qi in enumerate(q):
+            cand = self.index.probe(qi)
+            d, j = self._topk(self.distances(qi, cand), k)
+            dists[i, :d.shape[1]] = d[0]; rows[i, :d.shape[1]] = cand[j[0]]
+        return dists, rows
+
+    @staticmethod
+    def _topk(d, k):
+        k = min(k, d.shape[1])
+        if k < d.shape[1]:
+            idx = np.argpartition(d, k - 1, axis=1)[:, :k]
+        else:
+            idx = np.broadcast_to(np.arange(k), d.shape).copy()
+        part = np.take_along_axis(d, idx, axis=1)
+        order = np.argsort(part, axis=1)
+        return np.take_along_axis(part, order, axis=1), np.take_along_axis(idx, order, axis=1)
+
+    def _identities(self):
+        if self._groups is None:
+            labels, ident = np.unique(np.asarray(self.names, dtype=object), return_inverse=True)
+            self._groups = (list(labels), ident.astype(np.int64), self._grouping(ident))
+        return self._groups
+
+    def identities(self):
+        """``(labels, ids)``: the distinct names and each row's index into them."""
+        if not self.n:
+            return [], np.zeros(0, dtype=np.int64)
+        labels, ident, _ = self._identities()
+        return labels, ident
+
+    @staticmethod
+    def _grouping(col_ident):
+        order = np.argsort(col_ident, kind='stable')
+        sorted_ident = col_ident[order]
+        starts = np.flatnonzero(np.r_[True, sorted_ident[1:] != sorted_ident[:-1]])
+        return order, starts, sorted_ident[starts]
+
+    @staticmethod
+    def _aggregate(d, grouping, agg):
+        order, starts, _ = grouping
+        d = d[:, order]
+        if agg == 'min':
+            return np.minimum.reduceat(d, starts, axis=1)
+        return np.add.reduceat(d, starts, axis=1) / np.diff(np.r_[starts, d.shape[1]])
+
+    def match_identities(self, queries, k=1, agg='min'):
+        """Top-``k`` identities per query as ``[[(name, dist), ...], ...]``.
+
+        ``agg`` combines a student's samples: ``min`` (closest sample, the
+        classic nearest-neighbour rule) or ``mean`` (average over samples;
+        with an active index, over the samples among the candidates).
+        """
+        if agg not in AGGREGATES:
+            raise ValueError(f'unknown aggregate {agg!r}')
+        q = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        if not self.n or not len(q):
+            return [[] for _ in range(len(q))]
+        labels, ident, full = self._identities()
+        if not self._indexed():
+            per_ident = self._aggregate(self.distances(q), full, agg)
+            dists, idx = self._topk(per_ident, k)
+            ids = full[2][idx]
+            return [[(labels[j], float(v)) for j, v in zip(ri, rd)] for ri, rd in zip(ids, dists)]
+        out = []
+        for qi in q:
+            cand = self.index.probe(qi)
+            if not len(cand):
+                out.append([]); continue
+            grouping = self._grouping(ident[cand])
+            per_ident = self._aggregate(self.distances(qi, cand), grouping, agg)
+            dists, idx = self._topk(per_ident, k)
+            out.append([(labels[grouping[2][j]], float(v)) for j, v in zip(idx[0], dists[0])])
+        return out
@@ -0,0 +1,247 @@
+"""Process pool for the CPU-heavy dlib face detection and encoding.
+
+dlib holds the GIL, so running ``face_locations``/``face_encodings`` inside a
+request handler stalls every other eventlet client. Here they run in worker
+processes that each import ``face_recognition`` (and load its models) once.
+
+Submissions are bounded: when ``max_pending`` jobs are already queued or
+running, :class:`InferenceBusy` is raised instead of queuing without limit,
+and a job that takes longer than ``timeout`` raises
+:class:`InferenceTimeout`. When a worker dies (killed for memory, a crash in
+dlib) the pool is broken for good: it is dropped, the jobs that were in it
+raise :class:`InferenceFailed`, and the next submission starts a new pool. Waiting is done through ``offload`` (for example
+``eventlet.tpool.execute``) so the calling green thread yields to the hub.
+
+Workers are forked where the platform allows it; call :meth:`start` during
+startup, before the server spins up its own threads. Under ``spawn`` the
+main module is re-imported as ``__mp_main__`` in every worker, so the app
+keeps its startup work behind that check.
+"""
+import io, os, time, threading, atexit
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+
+DIM = 128
+
+
+class InferenceBusy(Exception):
+    pass
+
+
+class InferenceTimeout(Exception):
+    pass
+
+
+class InferenceFailed(Exception):
+    """A worker or the pool failed; not the frame's fault."""
+
+
+class BadFrame(ValueError):
+    """The image data does not decode."""
+
+
+# ---------- worker side ----------
+_fr = None
+_detector = None
+_min_face = 0  # px; smaller detected faces are not encoded
+
+def _init_worker(detector=None, min_face=0):
+    global _fr, _detector, _min_face
+    import face_recognition
+    from detection import Detector
+    _fr = face_recognition
+    _detector = Detector(**(detector or {}))
+    _min_face = min_face
+
+
+def _big_enough(box):
+    return box[2] - box[0] >= _min_face and box[1] - box[3] >= _min_face
+
+
+def _ping():
+    return os.getpid()
+
+
+def _decode(image):
+    from PIL import Image
+    try:
+        return np.array(Image.open(io.BytesIO(image)).convert('RGB'))
+    except Exception as e:
+        raise BadFrame(f'{type(e).__name__}: {e}') from e
+
+
+def analyze(image, locations=None, encode=True, motion=None):
+    """Detect (unless ``locations`` are given) and encode faces in a JPEG/PNG.
+
+    Returns ``{'locations': [(top, right, bottom, left), ...],
+    'encodings': float32 array (F, 128), 'timings': {stage: seconds}}``,
+    plus the updated ``motion`` state when one was passed in (see
+    :meth:`detection.Detector.detect`). Detected faces smaller than the
+    worker's ``min_face`` are left out and counted in ``'small'``.
+    """
+    t0 = time.perf_counter()
+    rgb = _decode(image)
+    timings = {'decode': time.perf_counter() - t0}
+    out = {}
+    if locations is None:
+        locations, det_timings, motion = _detector.detect(rgb, motion)
+        timings.update(det_timings)
+        if motion is not None:
+            out['motion'] = motion
+        if _min_face:
+            found = len(locations)
+            locations = [b for b in locations if _big_enough(b)]
+            out['small'] = found - len(locations)
+    locations = [tuple(int(v) for v in loc) for loc in locations]
+    t0 = time.perf_counter()
+    encs = _fr.face_encodings(rgb, locations) if encode and locations else []
+    if encode:
+        timings['encode'] = time.perf_counter() - t0
+    out.update(locations=locations, encodings=np.asarray(encs, dtype=np.float32).reshape(-1, DIM),
+               timings=timings)
+    return out
+
+
+def analyze_batch(jobs):
+    """``analyze`` over a list of ``(image, locations, encode, motion)`` jobs.
+
+    A frame that fails yields ``{'error': ...}`` instead of failing the
+    whole batch, with ``'bad_frame': True`` when it did not decode.
+    """
+    out = []
+    for job in jobs:
+        try:
+            out.append(analyze(*job))
+        except BadFrame as e:
+            out.append({'error': str(e), 'bad_frame': True})
+        except Exception as e:
+            out.append({'error': f'{type(e).__name__}: {e}'})
+    return out
+
+
+def encode_file(path):
+    """First face encoding in an image file, or ``None`` (enrollment)."""
+    img = _fr.load_image_file(path)
+    d = _fr.face_encodings(img)
+    return d[0] if d else None
+
+
+def enroll_file(path, allow_multi=False):
+    """Classify and encode one enrollment image (bulk enrollment).
+
+    Returns ``(status, faces, encoding)`` with status ``'ok'``, ``'no_face'``,
+    ``'multi_face'``, ``'face_too_small'`` (below the worker's ``min_face``)
+    or ``'decode_error'`` (the file is not a readable image). Multi-face
+    images are only encoded, from the largest face, when ``allow_multi`` is
+    set. Any other failure raises.
+    """
+    try:
+        img = _fr.load_image_file(path)
+    except FileNotFoundError:
+        raise
+    except (OSError, ValueError):  # PIL's UnidentifiedImageError is an OSError
+        return 'decode_error', 0, None
+    locs = _fr.face_locations(img)
+    if not locs:
+        return 'no_face', 0, None
+    status = 'ok' if len(locs) == 1 else 'multi_face'
+    if status == 'multi_face' and not allow_multi:
+        return status, len(locs), None
+    big = max(locs, key=lambda b: (b[2] - b[0]) * (b[1] - b[3]))
+    if not _big_enough(big):
+        return 'face_too_small', len(locs), None
+    enc = _fr.face_encodings(img, [big])[0]
+    return status, len(locs), np.asarray(enc, dtype=np.float32)
+
+
+# ---------- service ----------
+class InferenceService:
+
+    def __init__(self, workers=None, max_pending=None, timeout=10.0, offload=None, detector=None,
+                 min_face=0):
+        self.detector = detector or {}  # detection.Detector keyword arguments
+        self.min_face = min_face
+        self.workers = workers or max(1, (os.cpu_count() or 2) - 1)
+        self.max_pending = max_pending or 2 * self.workers
+        self.timeout = timeout
+        self.offload = offload
+        self.pending = 0
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                method = 'fork' if 'fork' in mp.get_all_start_methods() else 'spawn'
+                self._pool = ProcessPoolExecutor(self.workers, mp_context=mp.get_context(method),
+                                                 initializer=_init_worker, initargs=(self.detector, self.min_face))
+                atexit.register(self.shutdown)
+            return self._pool
+
+    def start(self):
+        """Create the pool now and wait for the workers to come up."""
+        pool = self._executor()
+        for fut in [pool.submit(_ping) for _ in range(self.workers)]:
+            fut.result()
+        return self
+
+    def _discard(self, pool):
+        """Drop a broken pool, so the next submission starts a fresh one."""
+        with self._lock:
+            if self._pool is not pool:
+                return  # already replaced
+            self._pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def _release(self, fut, pool):
+        with self._lock:
+            self.pending -= 1
+        if fut is not None and not fut.cancelled() and isinstance(fut.exception(), BrokenProcessPool):
+            self._discard(pool)
+
+    def submit(self, fn, *args, **kwargs):
+        pool = self._executor()
+        with self._lock:
+            if self.pending >= self.max_pending:
+                raise InferenceBusy(f'{self.pending} inference jobs pending')
+            self.pending += 1
+        try:
+            fut = pool.submit(fn, *args, **kwargs)
+        except BrokenProcessPool as e:
+            self._release(None, pool)
+            self._discard(pool)
+            raise InferenceFailed(f'inference pool broken: {e}')
+        except Exception:
+            self._release(None, pool)
+            raise
+        fut.add_done_callback(lambda f: self._release(f, pool))
+        return fut
+
+    def result(self, fut, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        try:
+            if self.offload is not None:
+                return self.offload(fut.result, timeout)
+            return fut.result(timeout)
+        except FutureTimeout:
+            fut.cancel()
+            raise InferenceTimeout(f'inference took longer than {timeout}s')
+        except BrokenProcessPool as e:  # the pool is dropped by _release
+            raise InferenceFailed(f'inference worker died: {e}')
+
+    def run(self, fn, *args, timeout=None, **kwargs):
+        return self.result(self.submit(fn, *args, **kwargs), timeout)
+
+    def analyze(self, image, locations=None, encode=True, motion=None, timeout=None):
+        return self.run(analyze, image, locations, encode, motion, timeout=timeout)
+
+    def encode_file(self, path, timeout=None):
+        return self.run(encode_file, path, timeout=timeout)
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,261 @@
+"""Small in-process metrics: counters, gauges and histograms.
+
+Histograms keep cumulative bucket counts (for Prometheus-style export) and a
+ring buffer of the most recent observations for p50/p95/p99. Every metric
+may carry labels; :func:`render` writes the whole registry in the Prometheus
+text format, with the recent quantiles as a ``<name>_recent`` summary.
+
+:class:`Timer` collects per-stage timings for one request, and
+:func:`sampled_profile` profiles a random fraction of calls to a code path.
+"""
+import os, time, random, threading
+from contextlib import contextmanager
+import numpy as np
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+
+def _labels(labels, **extra):
+    items = list(labels.items()) + list(extra.items())
+    if not items:
+        return ''
+    esc = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{k}="{esc(v)}"' for k, v in items) + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help='', labels=None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self._lock:
+            self.value += n
+
+    def samples(self):
+        yield self.name, self.labels, self.value
+
+
+class Gauge:
+    """A set value, or ``fn()`` read at export time."""
+    kind = 'gauge'
+
+    def __init__(self, name, help='', labels=None, fn=None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.fn = fn
+        self._value = 0
+
+    def set(self, value):
+        self._value = value
+
+    @property
+    def value(self):
+        if self.fn is None:
+            return self._value
+        try:
+            return self.fn()
+        except Exception:
+            return float('nan')
+
+    def samples(self):
+        yield self.name, self.labels, self.value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help='', buckets=LATENCY_BUCKETS, window=2048, labels=None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self._recent = np.zeros(window)
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            i = int(np.searchsorted(self.buckets, value))
+            self.counts[i] += 1
+            self._recent[self.count % len(self._recent)] = value
+            self.count += 1
+            self.sum += value
+
+    def quantiles(self, qs=(0.5, 0.95, 0.99)):
+        with self._lock:
+            recent = self._recent[:min(self.count, len(self._recent))].copy()
+        if not len(recent):
+            return {q: 0.0 for q in qs}
+        return dict(zip(qs, np.quantile(recent, qs).tolist()))
+
+    def snapshot(self):
+        q = self.quantiles()
+        return {'count': self.count, 'sum': self.sum,
+                'p50': q[0.5], 'p95': q[0.95], 'p99': q[0.99]}
+
+    def samples(self):
+        with self._lock:
+            counts, count, total = list(self.counts), self.count, self.sum
+        cum = 0
+        for le, n in zip(self.buckets + ('+Inf',), counts):
+            cum += n
+            yield self.name + '_bucket', dict(self.labels, le=le), cum
+        yield self.name + '_sum', self.labels, total
+        yield self.name + '_count', self.labels, count
+
+
+REGISTRY = {}  # name + label string -> metric
+_registry_lock = threading.Lock()
+
+
+def _get(cls, name, labels, **kwargs):
+    key = name + _labels(labels)
+    metric = REGISTRY.get(key)
+    if metric is None:
+        with _registry_lock:
+            metric = REGISTRY.get(key)
+            if metric is None:
+                metric = REGISTRY[key] = cls(name, labels=labels, **kwargs)
+    return metric
+
+
+def histogram(name, help='', buckets=LATENCY_BUCKETS, **labels):
+    """Get or create the named histogram (one per label set)."""
+    return _get(Histogram, name, labels, help=help, buckets=buckets)
+
+
+def counter(name, help='', **labels):
+    """Get or create the named counter; by convention ``name`` ends in ``_total``."""
+    return _get(Counter, name, labels, help=help)
+
+
+def gauge(name, help='', fn=None, **labels):
+    g = _get(Gauge, name, labels, help=help)
+    if fn is not None:
+        g.fn = fn
+    return g
+
+
+def find(name):
+    """Every registered metric called ``name``, whatever its labels."""
+    return [m for m in list(REGISTRY.values()) if m.name == name]
+
+
+def _fmt(v):
+    if isinstance(v, float):
+        if v != v:
+            return 'NaN'
+        if v in (float('inf'), float('-inf')):
+            return '+Inf' if v > 0 else '-Inf'
+    return str(v)
+
+
+OPENMETRICS = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+TEXT_FORMAT = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def render(openmetrics=False):
+    """The registry in the Prometheus text exposition format (0.0.4).
+
+    Counter metadata carries the full ``*_total`` sample name there; with
+    ``openmetrics`` it is the family name without the suffix, as OpenMetrics
+    requires, and the output ends in ``# EOF``.
+    """
+    families = {}
+    for metric in list(REGISTRY.values()):
+        families.setdefault(metric.name, []).append(metric)
+    out = []
+    for name, group in families.items():
+        first = group[0]
+        base = name[:-6] if openmetrics and first.kind == 'counter' and name.endswith('_total') else name
+        out.append(f'# HELP {base} {first.help}')
+        out.append(f'# TYPE {base} {first.kind}')
+        for metric in group:
+            for sample, labels, value in metric.samples():
+                out.append(f'{sample}{_labels(labels)} {_fmt(value)}')
+        if first.kind == 'histogram':  # recent-window quantiles alongside the buckets
+            out.append(f'# HELP {name}_recent {first.help} (last {len(first._recent)} observations)')
+            out.append(f'# TYPE {name}_recent summary')
+            for metric in group:
+                for q, v in metric.quantiles().items():
+                    out.append(f'{name}_recent{_labels(metric.labels, quantile=q)} {_fmt(v)}')
+    if openmetrics:
+        out.append('# EOF')
+    return '\n'.join(out) + '\n'
+
+
+# ---------- per-request timing ----------
+class Timer:
+    """Stage timings of one request: ``with timer.stage('decode'): ...``.
+
+    Stages entered twice add up; :meth:`add` merges timings measured
+    elsewhere (e.g. in an inference worker).
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - t0
+
+    def add(self, timings):
+        for name, secs in (timings or {}).items():
+            self.stages[name] = self.stages.get(name, 0.0) + secs
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def ms(self):
+        return {name: round(secs * 1000, 2) for name, secs in self.stages.items()}
+
+
+# ---------- sampling profiler hook ----------
+@contextmanager
+def sampled_profile(rate, out_dir, tag):
+    """Profile the block for a random ``rate`` fraction of calls.
+
+    Uses pyinstrument (a statistical profiler; HTML report) when installed,
+    otherwise cProfile (``.prof``, open with snakeviz or pstats). Reports go
+    to ``out_dir`` as ``<tag>-<timestamp>``. Yields the report path or None.
+    """
+    if rate <= 0 or random.random() >= rate:
+        yield None
+        return
+    os.makedirs(out_dir, exist_ok=True)
+    stem = os.path.join(out_dir, f'{tag}-{time.strftime("%Y%m%d-%H%M%S")}-{random.randrange(16**4):04x}')
+    try:
+        from pyinstrument import Profiler
+    except ImportError:
+        import cProfile
+        prof, path = cProfile.Profile(), stem + '.prof'
+        prof.enable()
+        try:
+            yield path
+        finally:
+            prof.disable()
+            prof.dump_stats(path)
+        return
+    prof, path = Profiler(), stem + '.html'
+    prof.start()
+    try:
+        yield path
+    finally:
+        prof.stop()
+        with open(path, 'w') as f:
+            f.write(prof.output_html())
@@ -0,0 +1,112 @@
+"""Cheap frame checks that run before any dlib work.
+
+A frame is decoded once, in grey at half resolution
+(``cv2.IMREAD_REDUCED_GRAYSCALE_2``, a few ms for a 640x480 JPEG), and
+rejected when it is
+
+``blurry``       variance of the Laplacian below ``min_blur``
+``too_dark``     mean grey level below ``min_brightness``
+``too_bright``   mean grey level above ``max_brightness``
+``duplicate``    its 64-bit difference hash (dHash) is within ``dedup`` bits
+                 of a frame this client sent in the last ``ttl`` seconds
+
+``unreadable`` is returned for data that does not decode; frames decoded
+elsewhere (video, see video.py) go straight to
+:meth:`QualityGate.inspect_gray`. The face-size check needs detection and
+runs in the inference worker (``face_too_small``, see
+:func:`inference.analyze`). Blur is measured on the half-resolution image,
+so ``min_blur`` is on that scale: sharp webcam frames score 60-300 there.
+"""
+import time, threading
+from collections import OrderedDict, deque
+import numpy as np
+
+REASONS = ('unreadable', 'blurry', 'too_dark', 'too_bright', 'duplicate', 'face_too_small')
+
+
+def decode_gray(image):
+    import cv2
+    return cv2.imdecode(np.frombuffer(image, np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_2)
+
+
+def dhash(gray, size=8):
+    """Difference hash: one bit per horizontally adjacent pair of a 9x8 thumbnail."""
+    import cv2
+    small = cv2.resize(gray, (size + 1, size), interpolation=cv2.INTER_AREA)
+    return int.from_bytes(np.packbits(small[:, 1:] > small[:, :-1]).tobytes(), 'big')
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+class QualityGate:
+    """Rejects unusable frames; remembers recent hashes per client for dedup."""
+
+    def __init__(self, min_blur=20.0, min_brightness=40.0, max_brightness=225.0,
+                 dedup=3, ttl=10.0, recent=4, max_clients=1024):
+        self.min_blur = min_blur
+        self.min_brightness = min_brightness
+        self.max_brightness = max_brightness
+        self.dedup = dedup
+        self.ttl = ttl
+        self.recent = recent
+        self.max_clients = max_clients
+        self._history = OrderedDict()  # client -> deque of (hash, time)
+        self._lock = threading.Lock()
+
+    def inspect(self, image):
+        """``(reason or None, stats)`` for one encoded image; stats has blur, brightness, hash."""
+        gray = decode_gray(image)
+        if gray is None or not gray.size:
+            return 'unreadable', {}
+        return self.inspect_gray(gray)
+
+    def inspect_gray(self, gray):
+        """:meth:`inspect` for a frame already decoded to grey at half resolution."""
+        import cv2
+        stats = {'blur': float(cv2.Laplacian(gray, cv2.CV_64F).var()),
+                 'brightness': float(gray.mean()), 'hash': dhash(gray)}
+        if stats['brightness'] < self.min_brightness:
+            return 'too_dark', stats
+        if stats['brightness'] > self.max_brightness:
+            return 'too_bright', stats
+        if stats['blur'] < self.min_blur:
+            return 'blurry', stats
+        return None, stats
+
+    def check(self, client, image):
+        """:meth:`inspect` plus the repeat check (skipped when ``client`` is None)."""
+        reason, stats = self.inspect(image)
+        if reason is None and self.dedup and client is not None and self.seen(client, stats['hash']):
+            reason = 'duplicate'
+        return reason, stats
+
+    def seen(self, client, h):
+        cutoff = time.monotonic() - self.ttl
+        with self._lock:
+            recent = self._history.get(client, ())
+            return any(t >= cutoff and hamming(h, old) <= self.dedup for old, t in recent)
+
+    def remember(self, client, h):
+        """Record a frame that was processed, so repeats of it are skipped."""
+        if client is None:
+            return
+        with self._lock:
+            recent = self._history.get(client)
+            if recent is None:
+                recent = self._history[client] = deque(maxlen=self.recent)
+                while len(self._history) > self.max_clients:
+                    self._history.popitem(last=False)
+            else:
+                self._history.move_to_end(client)
+            recent.append((h, time.monotonic()))
+
+
+def distinct(hashes, bits):
+    """Indexes of ``hashes`` to keep: each more than ``bits`` from every kept one."""
+    keep = []
+    for i, h in enumerate(hashes):
+        if h is None or all(hamming(h, hashes[j]) > bits for j in keep):
+            keep.append(i)
+    return keep
@@ -0,0 +1,131 @@
+"""Attendance exports: CSV, XLSX and Parquet writers fed from row iterators.
+
+Rows come straight off a streaming query, so nothing here holds more than
+one chunk in memory: CSV is produced as text chunks for a chunked HTTP
+response (or a file), XLSX goes through openpyxl's write-only workbook and
+Parquet is written one row group per chunk through pyarrow. openpyxl and
+pyarrow are listed in requirements.txt but only imported for their format;
+:func:`available` leaves out a format whose library is missing.
+
+Columns are ``(name, kind)`` pairs with kind ``'str'``, ``'int'`` or
+``'float'``; only Parquet uses the kind, for its schema.
+"""
+import csv, io, itertools, importlib.util
+
+FORMATS = {'csv': 'text/csv',
+           'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+           'parquet': 'application/vnd.apache.parquet'}
+CHUNK = 5000
+XLSX_MAX_ROWS = 1048575  # per sheet, below Excel's limit with the header
+
+
+def _chunks(rows, n):
+    it = iter(rows)
+    while True:
+        chunk = list(itertools.islice(it, n))
+        if not chunk:
+            return
+        yield chunk
+
+
+def csv_stream(columns, rows, chunk=CHUNK):
+    """CSV text, header first, then one piece per ``chunk`` rows."""
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    w.writerow([name for name, _ in columns])
+    yield buf.getvalue()
+    for part in _chunks(rows, chunk):
+        buf.seek(0); buf.truncate()
+        w.writerows(part)
+        yield buf.getvalue()
+
+
+def write_csv(path, columns, rows):
+    n = 0
+    def counted():
+        nonlocal n
+        for row in rows:
+            n += 1
+            yield row
+    with open(path, 'w', newline='') as f:
+        for text in csv_stream(columns, counted()):
+            f.write(text)
+    return n
+
+
+def write_xlsx(path, columns, rows):
+    try:
+        from openpyxl import Workbook
+    except ImportError as e:
+        raise RuntimeError(f'xlsx export needs openpyxl (pip install openpyxl): {e}')
+    wb = Workbook(write_only=True)
+    header = [name for name, _ in columns]
+    n = 0
+    ws = None
+    for row in rows:
+        if n % XLSX_MAX_ROWS == 0:  # new sheet when Excel's row limit is reached
+            ws = wb.create_sheet(f'attendance{n // XLSX_MAX_ROWS + 1}' if n else 'attendance')
+            ws.append(header)
+        ws.append(list(row))
+        n += 1
+    if ws is None:
+        wb.create_sheet('attendance').append(header)
+    wb.save(path)
+    return n
+
+
+def write_parquet(path, columns, rows, chunk=CHUNK * 10):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise RuntimeError(f'parquet export needs pyarrow (pip install pyarrow): {e}')
+    types = {'str': pa.string(), 'int': pa.int64(), 'float': pa.float64()}
+    schema = pa.schema([(name, types[kind]) for name, kind in columns])
+    n = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        for part in _chunks(rows, chunk):
+            cols = list(zip(*part))
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(c, type=f.type) for c, f in zip(cols, schema)], schema=schema))
+            n += len(part)
+    return n
+
+
+WRITERS = {'csv': write_csv, 'xlsx': write_xlsx, 'parquet': write_parquet}
+NEEDS = {'xlsx': 'openpyxl', 'parquet': 'pyarrow'}
+
+
+def available():
+    """Formats whose writer can be imported here, in FORMATS order."""
+    return [fmt for fmt in FORMATS if fmt not in NEEDS or importlib.util.find_spec(NEEDS[fmt])]
+
+
+def write(path, fmt, columns, rows):
+    """Write ``rows`` to ``path`` as ``fmt``; returns the row count."""
+    if fmt not in WRITERS:
+        raise ValueError(f'unknown format {fmt!r}; choose from {", ".join(WRITERS)}')
+    return WRITERS[fmt](path, columns, rows)
+
+
+def pivot(counts, subjects, held):
+    """Student x subject matrix from ``(username, subject, present)`` rows.
+
+    ``counts`` must be sorted by username (a student with no marks may come
+    as a single row with subject None); ``held`` maps subject -> sessions in
+    the range. Yields one row per student: username, then present count and
+    percentage for every subject. Returns ``(columns, rows)``.
+    """
+    columns = [('username', 'str')]
+    for s in subjects:
+        columns += [(f'{s} present', 'int'), (f'{s} %', 'float')]
+
+    def rows():
+        for username, group in itertools.groupby(counts, key=lambda r: r[0]):
+            present = {s: p for _, s, p in group}
+            row = [username]
+            for s in subjects:
+                p, h = present.get(s) or 0, held.get(s, 0)
+                row += [p, round(100.0 * p / h, 1) if h else None]
+            yield row
+    return columns, rows()
@@ -96,3 +96,98 @@ function startRecognition(subject, onResult) {
       alert(`${errorMsg}\n\n${errorDetail}\n\nTo fix this:\n1. Check browser permissions\n2. Go to browser settings\n3. Allow camera access for this site\n4. Refresh the page`);
     });
 }
+
+// Stream raw JPEG frames over the /recognize_stream Socket.IO namespace.
+// Keeps running (marking every student who appears) until stopRecognitionStream();
+// starting again stops the previous stream first.
+// Only one frame is in flight at a time; the server also drops overlapping frames.
+let streamSocket = null;
+let streamSession = null;  // the current start; a camera that opens after a stop/restart is closed
+
+function startRecognitionStream(subject, onResult) {
+  stopRecognitionStream();
+  const session = {};
+  streamSession = session;
+  const container = document.getElementById('videoContainer');
+  container.innerHTML = '';
+
+  const video = document.createElement('video');
+  video.autoplay = true;
+  video.playsInline = true;
+  video.style.width = '100%';
+  video.style.height = '100%';
+  container.appendChild(video);
+
+  const constraints = {
+    video: {
+      width: { ideal: 640 },
+      height: { ideal: 480 },
+      facingMode: 'user'
+    }
+  };
+
+  navigator.mediaDevices.getUserMedia(constraints)
+    .then(stream => {
+      if (streamSession !== session) {
+        stream.getTracks().forEach(t => t.stop());
+        return;
+      }
+      streamRef = stream;
+      video.srcObject = stream;
+
+      const canvas = document.createElement('canvas');
+      canvas.width = 640;
+      canvas.height = 480;
+      const ctx = canvas.getContext('2d');
+
+      const socket = io('/recognize_stream', { auth: { subject: subject } });
+      streamSocket = socket;
+      let inFlight = false;
+
+      function sendFrame() {
+        if (streamSocket !== socket || inFlight || !socket.connected) return;
+        ctx.drawImage(video, 0, 0, canvas.width, canvas.height);
+        canvas.toBlob(blob => {
+          if (!blob) return;
+          blob.arrayBuffer().then(buf => {
+            inFlight = true;
+            socket.emit('frame', buf);
+          });
+        }, 'image/jpeg', 0.7);
+      }
+
+      socket.on('result', j => {
+        inFlight = false;
+        if (onResult) onResult(j);
+        setTimeout(sendFrame, 100);
+      });
+      socket.on('connect', () => sendFrame());
+      socket.on('connect_error', err => console.error('Stream error:', err));
+      // re-arm if a frame was dropped or lost
+      socket.on('disconnect', () => { inFlight = false; });
+      const watchdog = setInterval(() => {
+        if (streamSocket !== socket) return clearInterval(watchdog);
+        inFlight = false;
+        sendFrame();
+      }, 3000);
+    })
+    .catch(error => {
+      console.error('Camera permission error:', error);
+      const log = document.getElementById('log');
+      if (log) {
+        log.innerHTML = `<div style="color: #721c24;">❌ Camera Access Denied<br><small>${error.message || error.name}</small></div>`;
+      }
+    });
+}
+
+function stopRecognitionStream() {
+  streamSession = null;
+  if (streamSocket) {
+    streamSocket.disconnect();
+    streamSocket = null;
+  }
+  if (streamRef) {
+    streamRef.getTracks().forEach(t => t.stop());
+    streamRef = null;
+  }
+}
@@ -0,0 +1,66 @@
+// Keyset pager for the paginated /api/* endpoints. Each call to next()
+// appends one page of rows to a table body; the first page is only fetched
+// once the table scrolls into view, and the "load more" button disappears
+// after the last page.
+function createPager(url, tbody, renderRow, moreBtn, emptyText) {
+  let cursor = null, loading = false, loaded = 0, started = false;
+
+  function message(text) {
+    const tr = document.createElement('tr');
+    const td = document.createElement('td');
+    td.colSpan = 10;
+    td.className = 'empty-message';
+    td.textContent = text;
+    tr.appendChild(td);
+    tbody.appendChild(tr);
+  }
+
+  async function next() {
+    if (loading) return;
+    loading = true; started = true;
+    const sep = url.includes('?') ? '&' : '?';
+    try {
+      const r = await fetch(url + (cursor ? sep + 'cursor=' + encodeURIComponent(cursor) : ''));
+      const data = await r.json();
+      if (!data.ok) { message('❌ ' + (data.error || 'Could not load')); return; }
+      data.items.forEach(item => tbody.appendChild(renderRow(item)));
+      loaded += data.items.length;
+      if (!loaded) message(emptyText || 'Nothing here yet.');
+      cursor = data.next;
+    } catch (e) {
+      console.error('Error:', e);
+      message('❌ Error: ' + e.message);
+    } finally {
+      loading = false;
+      if (moreBtn) moreBtn.style.display = cursor ? '' : 'none';
+    }
+  }
+
+  if (moreBtn) {
+    moreBtn.style.display = 'none';
+    moreBtn.addEventListener('click', next);
+  }
+  if ('IntersectionObserver' in window) {
+    const seen = new IntersectionObserver(entries => {
+      if (!started && entries.some(e => e.isIntersecting)) { seen.disconnect(); next(); }
+    });
+    seen.observe(tbody.closest('table') || tbody);
+  } else {
+    next();
+  }
+  return { next };
+}
+
+// <td> with text content (never HTML) and an optional badge class
+function pagerCell(text, badge) {
+  const td = document.createElement('td');
+  if (badge) {
+    const span = document.createElement('span');
+    span.className = 'badge ' + badge;
+    span.textContent = text;
+    td.appendChild(span);
+  } else {
+    td.textContent = text == null ? '—' : text;
+  }
+  return td;
+}
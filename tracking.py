@@ -0,0 +1,96 @@
+"""Per-stream face tracking across frames.
+
+Boxes from ``face_locations`` (``(top, right, bottom, left)``) are matched to
+the previous frame's tracks by IoU, greedily from the best overlap down.
+Once a track has been identified ``confirm_hits`` times in a row with the
+same identity it is confirmed, and the face is not encoded again while it
+stays in view. Only new and unconfirmed tracks need encoding.
+"""
+import itertools
+import numpy as np
+
+
+def iou_matrix(a, b):
+    """IoU between every box in ``a`` and every box in ``b`` (trbl order)."""
+    a = np.asarray(a, dtype=np.float64).reshape(-1, 4)
+    b = np.asarray(b, dtype=np.float64).reshape(-1, 4)
+    top = np.maximum(a[:, None, 0], b[None, :, 0])
+    right = np.minimum(a[:, None, 1], b[None, :, 1])
+    bottom = np.minimum(a[:, None, 2], b[None, :, 2])
+    left = np.maximum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(bottom - top, 0, None) * np.clip(right - left, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 1] - a[:, 3])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 1] - b[:, 3])
+    union = area_a[:, None] + area_b[None, :] - inter
+    return np.where(union > 0, inter / np.maximum(union, 1e-9), 0.0)
+
+
+class Track:
+    __slots__ = ('id', 'box', 'identity', 'distance', 'hits', 'misses', 'confirmed')
+
+    def __init__(self, tid, box):
+        self.id = tid; self.box = tuple(box)
+        self.identity = None; self.distance = None
+        self.hits = 0; self.misses = 0; self.confirmed = False
+
+    def to_dict(self):
+        return {'id': self.id, 'box': list(self.box), 'username': self.identity,
+                'confirmed': self.confirmed}
+
+
+class FaceTracker:
+
+    def __init__(self, iou_threshold=0.3, max_misses=5, confirm_hits=1):
+        self.iou_threshold = iou_threshold
+        self.max_misses = max_misses      # frames a track survives unseen
+        self.confirm_hits = confirm_hits  # consistent identifications to confirm
+        self.tracks = []
+        self._ids = itertools.count(1)
+
+    def has_confirmed(self):
+        return any(t.confirmed for t in self.tracks)
+
+    def update(self, boxes):
+        """Match this frame's boxes to tracks; returns one track per box."""
+        boxes = [tuple(int(v) for v in b) for b in boxes]
+        out = [None] * len(boxes)
+        used = set()
+        if self.tracks and boxes:
+            ious = iou_matrix([t.box for t in self.tracks], boxes)
+            for flat in np.argsort(-ious, axis=None):
+                ti, bi = divmod(int(flat), len(boxes))
+                if ious[ti, bi] < self.iou_threshold:
+                    break
+                if ti in used or out[bi] is not None:
+                    continue
+                used.add(ti)
+                out[bi] = self.tracks[ti]
+        for ti, t in enumerate(self.tracks):
+            t.misses = 0 if ti in used else t.misses + 1
+        for bi, box in enumerate(boxes):
+            if out[bi] is None:
+                out[bi] = Track(next(self._ids), box)
+            out[bi].box = box
+        live = {id(t) for t in out}
+        self.tracks = [t for t in self.tracks if id(t) not in live and t.misses <= self.max_misses] + out
+        return out
+
+    @staticmethod
+    def needs_encoding(track):
+        return not track.confirmed
+
+    def observe(self, track, identity, distance=None):
+        """Record an identification (``None`` = no match).
+
+        Returns True when this observation confirms the track.
+        """
+        if identity is None or identity != track.identity:
+            track.identity = identity
+            track.hits = 1 if identity is not None else 0
+        else:
+            track.hits += 1
+        track.distance = distance
+        if identity is not None and not track.confirmed and track.hits >= self.confirm_hits:
+            track.confirmed = True
+            return True
+        return False
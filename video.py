@@ -0,0 +1,149 @@
+"""Frames and identity votes for offline attendance from recorded footage.
+
+A lecture recording is mostly the same picture for minutes at a time, so
+:func:`sample_video` does not decode every frame at a fixed rate: it keeps a
+sampling interval between ``min_interval`` and ``max_interval`` seconds,
+doubling it while consecutive samples barely differ (mean absolute
+difference of a 32x18 grey thumbnail below ``still``) and halving it when
+the scene changes (above ``change``). Frames in between are only grabbed,
+never converted. :func:`read_stills` does the same job for a folder of
+photos, one frame each.
+
+:class:`Votes` aggregates matches across frames: a student gets at most one
+vote per frame (their closest face), and is accepted once they have
+``min_votes`` votes, so a single false match in one frame does not mark
+anyone.
+"""
+import os
+import numpy as np
+from encoding_store import IMAGE_EXTS
+
+
+def _thumb(frame):
+    import cv2
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, (32, 18), interpolation=cv2.INTER_AREA).astype(np.float32)
+
+
+def probe(path):
+    """``(fps, frame count, duration in s)`` of a video; raises ValueError if unreadable."""
+    import cv2
+    cap = cv2.VideoCapture(path)
+    try:
+        if not cap.isOpened():
+            raise ValueError('unreadable video')
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        if not fps or fps != fps or fps > 240:  # missing or bogus container metadata
+            fps = 25.0
+        count = max(int(cap.get(cv2.CAP_PROP_FRAME_COUNT) or 0), 0)
+        return fps, count, count / fps
+    finally:
+        cap.release()
+
+
+def sample_video(path, interval=1.0, min_interval=0.25, max_interval=4.0, still=2.0, change=12.0):
+    """Yield ``(frame index, seconds, BGR frame)`` at an adaptive interval."""
+    import cv2
+    fps = probe(path)[0]
+    cap = cv2.VideoCapture(path)
+    step = min(max(interval, min_interval), max_interval)
+    index, due, prev = -1, 0.0, None
+    try:
+        while cap.grab():
+            index += 1
+            t = index / fps
+            if t + 1e-6 < due:
+                continue
+            ok, frame = cap.retrieve()
+            if not ok:
+                break
+            thumb = _thumb(frame)
+            if prev is not None:
+                diff = float(np.abs(thumb - prev).mean())
+                if diff < still:
+                    step = min(step * 2, max_interval)
+                elif diff > change:
+                    step = max(step / 2, min_interval)
+            prev = thumb
+            due = t + step
+            yield index, t, frame
+    finally:
+        cap.release()
+
+
+def list_stills(folder):
+    return sorted(os.path.join(folder, f) for f in os.listdir(folder) if f.lower().endswith(IMAGE_EXTS))
+
+
+def read_stills(paths):
+    """Yield ``(index, None, BGR frame)`` per readable image in ``paths``."""
+    import cv2
+    for i, path in enumerate(paths):
+        frame = cv2.imread(path)
+        if frame is not None:
+            yield i, None, frame
+
+
+def encode_frames(frames, gate=None, rejected=None, quality=90):
+    """``(index, seconds, JPEG bytes)`` for each frame ``gate`` lets through.
+
+    Frames are checked at half resolution, on the scale of
+    :meth:`quality.QualityGate.inspect_gray`; rejects are counted by reason
+    in the ``rejected`` dict.
+    """
+    import cv2
+    for index, t, frame in frames:
+        if gate is not None:
+            h, w = frame.shape[:2]
+            gray = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), (w // 2, h // 2),
+                              interpolation=cv2.INTER_AREA)
+            reason, _ = gate.inspect_gray(gray)
+            if reason:
+                if rejected is not None:
+                    rejected[reason] = rejected.get(reason, 0) + 1
+                continue
+        ok, jpeg = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        if ok:
+            yield index, t, jpeg.tobytes()
+
+
+class Votes:
+    """Per-student votes across frames, from ``(name, distance)`` matches."""
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.votes = {}  # name -> [votes, sum of distances, best distance, first seen]
+        self.frames = 0
+
+    def add(self, matches, t=None):
+        """Count one frame's matches (top-1 ``(name, distance)`` lists, as from Gallery)."""
+        best = {}
+        for top in matches:
+            if top and top[0][1] <= self.threshold:
+                name, d = top[0]
+                best[name] = min(d, best.get(name, d))
+        self.frames += 1
+        for name, d in best.items():
+            v = self.votes.get(name)
+            if v is None:
+                self.votes[name] = [1, d, d, t]
+            else:
+                v[0] += 1; v[1] += d; v[2] = min(v[2], d)
+        return list(best)
+
+    def result(self, min_votes):
+        """``(accepted names, {name: details})`` for names with at least ``min_votes`` votes.
+
+        ``min_votes`` is not lowered for short recordings: with fewer frames
+        than that nobody is accepted (see :meth:`too_few_frames`).
+        """
+        need = max(1, min_votes)
+        details = {}
+        for name, (n, total, best, first) in sorted(self.votes.items()):
+            details[name] = {'votes': n, 'mean_distance': round(total / n, 4), 'best_distance': round(best, 4),
+                             'confidence': round(1 - total / n / self.threshold, 3), 'first_seen': first,
+                             'accepted': n >= need}
+        return [n for n, d in details.items() if d['accepted']], details
+
+    def too_few_frames(self, min_votes):
+        return self.frames < min_votes